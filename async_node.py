@@ -0,0 +1,207 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from node import Node, Message, FRAME_HEADER, MAX_MESSAGE_SIZE, bytes_to_Message
+from sync import STALL_CHECK_INTERVAL
+from sendqueue import SendQueue, message_priority
+
+"""
+    asyncio transport for Node. One event loop thread owns the peer tables
+    and every stream, messages that touch the blockchain are handled on a
+    single-thread executor so validation never blocks the loop.
+    The message protocol itself is Node.handle_message.
+"""
+
+LISTEN_BACKLOG = 128
+MAX_PEERS = 125
+SYNC_INTERVAL = 600
+LOOP_MESSAGES = {'GET_PEERS', 'PEERS_LIST', 'PORT'} # no blockchain access, handled on the loop
+
+class AsyncPeer:
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.queue = SendQueue()
+        self.ready = asyncio.Event() # set when frames were queued
+        self.drain_task = None
+
+    # same call Node uses on sockets
+    def getpeername(self):
+        return self.address
+
+
+class AsyncNode(Node):
+    def start(self):
+        self.MAX_CONNETIONS = MAX_PEERS
+        self.executor = ThreadPoolExecutor(max_workers=1) # blockchain is not thread-safe
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        # raises here if the port cannot be bound
+        asyncio.run_coroutine_threadsafe(self.start_server(), self.loop).result()
+
+    async def start_server(self):
+        self.server = await asyncio.start_server(self.accept_peer, self.host, self.port,
+                                                 backlog=LISTEN_BACKLOG, reuse_address=True)
+        self.sync_task = self.loop.create_task(self.periodic_sync_task())
+        self.watchdog_task = self.loop.create_task(self.download_watchdog_task())
+
+    def close(self):
+        self.active = False
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+        if self.log: print('node closed')
+
+    async def shutdown(self):
+        self.sync_task.cancel()
+        self.watchdog_task.cancel()
+        self.server.close()
+        writers = []
+        for peer in list(self.peer_sockets.values()):
+            peer.queue.close()
+            peer.ready.set()
+            peer.writer.close()
+            writers.append(peer.drain_task)
+        await asyncio.wait(writers + [self.loop.create_task(self.server.wait_closed())], timeout=1)
+
+    def in_loop(self):
+        return threading.current_thread() is self.loop_thread
+
+    def call_in_loop(self, function, *args):
+        if self.in_loop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    # peer tables are only changed on the loop
+    def add_peer(self, address, reader, writer):
+        peer = AsyncPeer(address, reader, writer)
+        self.peers.add(address)
+        self.peer_sockets[address] = peer
+        self.send_queues[peer] = peer.queue
+        peer.drain_task = self.loop.create_task(self.drain_peer(peer))
+        return peer
+
+    def remove_peer(self, address):
+        if address in self.peers:
+            self.peers.discard(address)
+            peer = self.peer_sockets.pop(address, None)
+            self.send_queues.pop(peer, None)
+            if peer:
+                peer.queue.close()
+                peer.ready.set()
+            self.known_inventory.pop(peer, None)
+            self.downloader.drop_peer(peer)
+            self.listen_ports.pop(address, None)
+            if self.log: print(f'Disconnected from: {address}')
+
+    async def accept_peer(self, reader, writer):
+        address = writer.get_extra_info('peername')[:2]
+        await self.serve_peer(self.add_peer(address, reader, writer))
+
+    async def serve_peer(self, peer):
+        if self.log: print(f"Connected to {peer.address}", flush=True)
+
+        self.send_to_peer(peer, Message('GET_LATEST_BLOCK', None)) # ask after connecting
+        self.get_peer_list(peer)
+        try:
+            while self.active:
+                (length,) = FRAME_HEADER.unpack(await peer.reader.readexactly(FRAME_HEADER.size))
+                if length > MAX_MESSAGE_SIZE:
+                    raise ValueError(f'Message of {length} bytes exceeds limit of {MAX_MESSAGE_SIZE}')
+                message = bytes_to_Message(await peer.reader.readexactly(length))
+
+                if message.m_type in LOOP_MESSAGES:
+                    self.handle_message(peer, message)
+                else:
+                    # one message at a time per peer keeps its messages in order
+                    await self.loop.run_in_executor(self.executor, self.handle_message, peer, message)
+        except asyncio.IncompleteReadError:
+            pass # peer disconnected
+        except Exception as e:
+            if self.log: print(f'Node connection error: {e}')
+        finally:
+            peer.writer.close()
+            self.remove_peer(peer.address)
+
+    async def periodic_sync_task(self, interval=SYNC_INTERVAL):
+        while self.active:
+            self.broadcast(Message('GET_LATEST_BLOCK', None))
+            if len(self.peers) < self.MAX_CONNETIONS:
+                self.broadcast(Message('GET_PEERS', None))
+            await asyncio.sleep(interval)
+
+    # stalled downloads are re-assigned on the executor, next to the message handling
+    async def download_watchdog_task(self, interval=STALL_CHECK_INTERVAL):
+        while self.active:
+            await asyncio.sleep(interval)
+            await self.loop.run_in_executor(self.executor, self.reassign_stalled)
+
+    # Blocks the calling thread until connected, from the loop itself it only schedules the connection
+    def connect_to_peer(self, peer_host, peer_port):
+        if self.in_loop():
+            self.loop.create_task(self.connect_task(peer_host, peer_port))
+            return None
+        return asyncio.run_coroutine_threadsafe(self.open_peer(peer_host, peer_port), self.loop).result()
+
+    async def connect_task(self, peer_host, peer_port):
+        try:
+            await self.open_peer(peer_host, peer_port)
+        except OSError:
+            if self.log: print(f'Failed to connect to: {(peer_host, peer_port)}')
+
+    async def open_peer(self, peer_host, peer_port):
+        address = (peer_host, peer_port)
+        reader, writer = await asyncio.open_connection(peer_host, peer_port)
+        peer = self.add_peer(address, reader, writer)
+        self.listen_ports[address] = address
+
+        # share listening port
+        self.send_to_peer(peer, Message("PORT", self.port))
+        if self.log: print(f"Connected to peer {peer_host}:{peer_port}")
+
+        self.loop.create_task(self.serve_peer(peer))
+        return peer
+
+    # encoded on the calling thread, queued by the loop
+    def send_to_peer(self, peer, message):
+        if self.log: print(f'Sending: {message.m_type}, to {peer.getpeername()}')
+        self.call_in_loop(self.queue_frame, peer, message.to_frame(), message_priority(message.m_type))
+
+    def queue_frame(self, peer, frame, priority):
+        if peer.queue.put(frame, priority):
+            peer.ready.set()
+        elif not peer.queue.closed:
+            self.queue_overflow(peer, priority)
+
+    # One writer per peer, drain() waits while the socket buffer is full
+    async def drain_peer(self, peer):
+        try:
+            while True:
+                frame = peer.queue.pop()
+                if frame is None:
+                    if peer.queue.closed:
+                        break
+                    peer.ready.clear()
+                    await peer.ready.wait()
+                    continue
+                peer.writer.write(frame)
+                await peer.writer.drain()
+        except (ConnectionError, OSError) as e:
+            if self.log: print(f"Error sending message to peer: {e}")
+            peer.writer.close()
+
+    def disconnect_peer(self, peer):
+        self.call_in_loop(peer.writer.close)
+
+    def broadcast(self, message: Message):
+        message.broadcast = True
+        self.call_in_loop(self.broadcast_frame, message.to_frame(), message_priority(message.m_type))
+
+    def broadcast_frame(self, frame, priority):
+        for peer in list(self.peer_sockets.values()):
+            self.queue_frame(peer, frame, priority)
@@ -0,0 +1,44 @@
+import sys
+import time
+import jsonpickle
+from blockchain import Block
+from transaction import Transaction, Input, Output
+from functions import generate_address
+from codec import encode_block, decode_block
+
+"""
+    Size and encode/decode time of a block with signed transactions,
+    jsonpickle (the old wire format) against the binary codec.
+    Usage: python bench_codec.py [transactions] [rounds]
+"""
+
+def make_block(tx_count):
+    private_key, address = generate_address()
+    transactions = [Transaction([], [Output(address, 6.25)])]
+    for i in range(tx_count):
+        tx = Transaction([Input(f'{i:064x}', 0)], [Output(address, 1), Output(address, 0.5)], i)
+        tx.sign(private_key)
+        transactions.append(tx)
+    return Block(1, '0' * 64, transactions, int(time.time()), 0, 4)
+
+def measure(name, encode, decode, block, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        data = encode(block)
+    encode_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decode(data)
+    decode_time = (time.perf_counter() - start) / rounds
+
+    size = len(data.encode() if isinstance(data, str) else data)
+    print(f'{name:12} {size:>10} B  encode {encode_time * 1000:8.2f} ms  decode {decode_time * 1000:8.2f} ms')
+
+if __name__ == '__main__':
+    tx_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    block = make_block(tx_count)
+    print(f'Block with {tx_count} signed transactions, {rounds} rounds')
+    measure('jsonpickle', jsonpickle.encode, jsonpickle.decode, block, rounds)
+    measure('codec', encode_block, decode_block, block, rounds)
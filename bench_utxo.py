@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import time
+import redis
+from blockchain import Block
+from transaction import Transaction, Input, Output
+from utxo import MemoryUTXOStore, SQLiteUTXOStore, RedisUTXOStore
+
+"""
+    UTXO backends against each other: applying blocks, looking up outputs
+    and balances, and undoing the blocks again as in a reorg.
+    Redis uses database BENCH_REDIS_DB, which is cleared, and is skipped
+    when no server is running.
+    Usage: python bench_utxo.py [blocks] [transactions per block]
+"""
+
+BENCH_REDIS_DB = 15
+ADDRESSES = 100
+
+# A coinbase with tx_count outputs, then blocks whose transactions each spend
+# one output of the previous block
+def make_blocks(block_count, tx_count):
+    coinbase = Transaction([], [Output(f'address{i % ADDRESSES}', 50) for i in range(tx_count)])
+    blocks = [Block(0, '0' * 64, [coinbase], int(time.time()), 0, 1)]
+    outpoints = [(coinbase.compute_txid(), vout) for vout in range(tx_count)]
+    for index in range(1, block_count + 1):
+        transactions = [Transaction([Input(txid, vout)], [Output(f'address{i % ADDRESSES}', 50)])
+                        for i, (txid, vout) in enumerate(outpoints)]
+        blocks.append(Block(index, blocks[-1].compute_hash(), transactions, int(time.time()), 0, 1))
+        outpoints = [(tx.compute_txid(), 0) for tx in transactions]
+    return blocks, outpoints
+
+def measure(name, utxos, blocks, outpoints):
+    utxos.reset()
+    start = time.perf_counter()
+    for block in blocks:
+        utxos.apply_block(block, block.compute_hash())
+    apply_time = (time.perf_counter() - start) / len(blocks)
+
+    utxos.cache.clear() # lookups hit the backend
+    start = time.perf_counter()
+    for txid, vout in outpoints:
+        utxos.get(txid, vout)
+    get_time = (time.perf_counter() - start) / len(outpoints)
+
+    start = time.perf_counter()
+    for i in range(ADDRESSES):
+        utxos.balance(f'address{i}')
+    balance_time = (time.perf_counter() - start) / ADDRESSES
+
+    start = time.perf_counter()
+    for block in reversed(blocks[1:]):
+        utxos.disconnect_block(block, block.compute_hash())
+    undo_time = (time.perf_counter() - start) / (len(blocks) - 1)
+
+    print(f'{name:8} apply {apply_time * 1000:8.2f} ms/block  get {get_time * 1e6:8.1f} us  '
+          f'balance {balance_time * 1e6:8.1f} us  undo {undo_time * 1000:8.2f} ms/block')
+
+if __name__ == '__main__':
+    block_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    tx_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    blocks, outpoints = make_blocks(block_count, tx_count)
+    print(f'{block_count} blocks with {tx_count} transactions')
+
+    measure('memory', MemoryUTXOStore(), blocks, outpoints)
+    with tempfile.TemporaryDirectory() as directory:
+        utxos = SQLiteUTXOStore(os.path.join(directory, 'utxos.sqlite3'))
+        measure('sqlite', utxos, blocks, outpoints)
+        utxos.close()
+    try:
+        utxos = RedisUTXOStore(db=BENCH_REDIS_DB)
+        utxos.redis.ping()
+    except redis.exceptions.ConnectionError:
+        print('redis    skipped, no server')
+    else:
+        measure('redis', utxos, blocks, outpoints)
+        utxos.close()
@@ -1,10 +1,23 @@
-from collections import deque
+from collections import deque, OrderedDict
+import itertools
 import json
 import time
 import hashlib
+import struct
 from transaction import*
 from storage import StorageManager
-import redis
+from miner import ParallelMiner
+from verify import BatchVerifier, SignatureCache
+from mempool import Mempool, MAX_BLOCK_BYTES, MAX_BLOCK_TXS
+from utxo import UTXOStore, CoinsView, open_utxo_store, MAX_UNDO_DEPTH
+
+# index, previous_hash, merkle_root, timestamp, difficulty - the nonce is appended last
+HEADER_FORMAT = struct.Struct('>Q32s32sQI')
+LOCATOR_DENSE = 10 # consecutive tip hashes in a block locator
+MAX_ORPHANS = 100 # blocks waiting for their parent
+
+def block_work(block):
+    return 2 ** block.difficulty
 
 class Block:
     def __init__(self, index, previous_hash, transactions, timestamp, nonce, difficulty):
@@ -15,6 +28,21 @@ class Block:
         self.nonce = nonce
         self.difficulty = difficulty
         self.merkle_root = self.calculate_merkle_root()
+        self.chain_work = None # work of the chain up to this block, set when connected
+        self._midstate = None # (header fields, hashed prefix)
+        self._hash = None # (midstate, nonce, hash)
+
+    # hashing caches are never serialized, they are rebuilt on demand
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_midstate'] = None
+        state['_hash'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._midstate = None
+        self._hash = None
 
     def calculate_merkle_root(self):
         if not self.transactions:
@@ -38,198 +66,335 @@ class Block:
 
         return transaction_hashes[0]
 
+    def header_prefix(self) -> bytes:
+        return HEADER_FORMAT.pack(self.index,
+                                  hash_to_bytes(self.previous_hash),
+                                  hash_to_bytes(self.merkle_root),
+                                  int(self.timestamp),
+                                  self.difficulty)
+
+    # SHA-256 state after the constant part of the header, reused for every nonce
+    def header_midstate(self):
+        key = (self.index, self.previous_hash, self.merkle_root, self.timestamp, self.difficulty)
+        if self._midstate is None or self._midstate[0] != key:
+            self._midstate = (key, hashlib.sha256(self.header_prefix()))
+        return self._midstate[1]
+
+    # Memoized until a header field changes
     def compute_hash(self):
-        block_data = {
-            'index': self.index,
-            'root': self.merkle_root,
-            'timestamp': self.timestamp,
-            'previous_hash': self.previous_hash,
-            'difficulty': self.difficulty,
-            'nonce': self.nonce
-        }
-        block_string = json.dumps(block_data, sort_keys=True)
-        return hashlib.sha256(hashlib.sha256(block_string.encode()).digest()).hexdigest()
+        midstate = self.header_midstate()
+        if self._hash is None or self._hash[0] is not midstate or self._hash[1] != self.nonce:
+            self._hash = (midstate, self.nonce, hash_with_nonce(midstate, self.nonce))
+        return self._hash[2]
 
     
-    def valid_transactions(self, utxos) -> bool:
-        used_utxos = set()
+    # Spends and creates outputs in the view while checking, the caller
+    # flushes the view on success or discards it.
+    # Signatures are checked last, as one batch for the whole block
+    def valid_transactions(self, utxos: CoinsView, verifier: BatchVerifier = None) -> bool:
+        checks = []
         for tx in self.transactions:
             input_value = 0
             output_value = sum(output.amount for output in tx.outputs)
 
             for input in tx.inputs:
-                key = (input.prev_txid, input.vout)
-                #  Avoid double-spend
-                if key not in utxos or key in used_utxos:
+                #  Avoid double-spend, spent outputs are gone from the view
+                utxo = utxos.spend((input.prev_txid, input.vout))
+                if utxo is None:
                     return False
+                input_value += utxo.amount
 
-                input_value += utxos[key].amount
-                used_utxos.add(key)
-
-            if not tx.verify() or \
+            tx_checks = tx.signature_checks()
+            if tx_checks is None or \
                 (len(tx.inputs) > 0 and input_value < output_value):
                 return False
+            checks.extend(tx_checks)
+            utxos.add_outputs(tx)
 
-        return True
+        if verifier is None:
+            return all(verify_check(check) for check in checks)
+        return verifier.verify(checks)
     
 
 class Blockchain:
-    def __init__(self, node):
+    def __init__(self, node, utxos: UTXOStore = None, storage=None):
         self.chain = deque()
-        self.unconfirmed_transactions = []
+        self.block_hashes = {} # hash -> block of the main chain
+        self.block_tree = {} # hash -> block of every branch, parents linked by previous_hash
+        self.tree_children = {} # hash -> hashes of its children in the block tree
+        self.orphans = OrderedDict() # hash -> block whose parent is unknown, oldest first
+        self.orphans_by_parent = {} # previous_hash -> hashes of its orphans
+        self.max_orphans = MAX_ORPHANS
+        self.max_undo_depth = MAX_UNDO_DEPTH
+        self.unconfirmed_transactions = Mempool()
+        self.max_block_bytes = MAX_BLOCK_BYTES
+        self.max_block_txs = MAX_BLOCK_TXS
         self.difficulty = 5 
         self.break_mining = False
-        self.utxos = redis.Redis(host='localhost', port=6379, db=0) # store unspent UTXOs, key is (txid, vout)
-        self.storage_manager = StorageManager()
+        # store unspent UTXOs, key is (txid, vout), Redis unless another backend is given
+        self.utxos = utxos if utxos is not None else open_utxo_store()
+        # MongoDB unless another block store is given (e.g. FlatFileBlockStore)
+        self.storage_manager = storage if storage is not None else StorageManager()
+        self.miner = ParallelMiner()
+        # successful verifications, mempool transactions are not re-verified inside blocks
+        self.signature_cache = SignatureCache()
+        self.verifier = BatchVerifier(cache=self.signature_cache)
         self.node = node
         node.set_blockchain(self)
 
     
     def create_genesis_block(self, difficulty):
         # Create the first block (genesis block) with arbitrary values
-        genesis_block = Block(0, "0", [], int(time.time()), 0, difficulty)  # Set the difficulty for the genesis block
+        genesis_block = Block(0, "0" * 64, [], int(time.time()), 0, difficulty)  # Set the difficulty for the genesis block
         self.proof_of_work(genesis_block)
-        self.chain.append(genesis_block)
+        self.connect_blocks([genesis_block])
 
-    # receive block from a peer
+    # Receive a block from a peer, True if the main chain changed.
+    # Blocks on side branches are kept in the block tree, blocks with an unknown parent in the orphan pool
     def receive_block(self, block: Block):
-        # need to restructure blockchain after fork
-        if block.index < self.chain.index:
-            return self.receive_past_block(block)
-        # skip if fetching genesis block
-        if len(self.chain) != 0:
-            proof = block.compute_hash()
-            last_block = self.latest_block()
-            prev_hash = last_block.compute_hash()         
-            if not self.is_valid_proof(self, proof) \
-                or proof == prev_hash \
-                or block.previous_hash != prev_hash \
-                or block.timestamp >= int(time.time()) \
-                or block.calculate_merkle_root() != block.merkle_root \
-                or not block.valid_transactions(self.utxos):
-                return False
-
-        self.chain.append(block)
-        self.update_utxos(block)
-        self.remove_confirmed_transactions(block.transactions)
-        self.break_mining = True
-
-        return True 
-
-    def receive_past_block(self, block: Block):
-        if block.index != self.chain[0].index - 1:
+        if not is_hash(block.previous_hash):
+            return False # the header could not be hashed
+        block_hash = block.compute_hash()
+        if block_hash in self.block_tree or block_hash in self.orphans:
             return False
-        self.chain.append(block)
-        if not self.reorganize_chain(block.index):
-            self.chain.pop()
+        # fetching genesis block
+        if len(self.chain) == 0:
+            self.connect_blocks([block])
+            self.break_mining = True
+            return True
+
+        # cheap header checks first
+        if block.timestamp >= int(time.time()) \
+            or not self.is_valid_proof(block, block_hash) \
+            or block.calculate_merkle_root() != block.merkle_root:
             return False
-        self.rebuild_utxos()
-        return True
-
-    def reorganize_chain(self, fork_index):
-        for i in range(fork_index, len(self.chain)):
-            current_block = self.chain[i]
-            if i > 0:
-                previous_block = self.chain[i - 1]
-                if current_block.previous_hash != previous_block.compute_hash():
-                    return False
-        for i in range(fork_index, len(self.chain)):
-            current_block = self.chain[i]
-            if i > 0:
-                previous_block = self.chain[i - 1]
-                if current_block.previous_hash != previous_block.compute_hash():
-                    self.switch_to_original_chain(fork_index)
-                    return False
-        if len(self.chain) <= fork_index:
-            self.switch_to_original_chain(fork_index)
+        parent = self.block_tree.get(block.previous_hash)
+        if parent is None:
+            self.add_orphan(block, block_hash)
+            return False
+        if block.index != parent.index + 1 or not self.valid_side_difficulty(block, parent):
             return False
+
+        best = self.add_to_tree(block, parent)
+        if best.chain_work <= self.calculate_cumulative_difficulty():
+            return False # side branch
+        return self.switch_to_branch(best)
+
+    # Adds the block and the orphans waiting for it, returns the most-work block among them
+    def add_to_tree(self, block, parent):
+        block.chain_work = parent.chain_work + block_work(block)
+        self.tree_add(block)
+        best = block
+        pending = [block]
+        while pending:
+            parent = pending.pop()
+            for orphan in self.pop_orphans(parent.compute_hash()):
+                if orphan.index != parent.index + 1 or not self.valid_side_difficulty(orphan, parent):
+                    continue
+                orphan.chain_work = parent.chain_work + block_work(orphan)
+                self.tree_add(orphan)
+                pending.append(orphan)
+                if orphan.chain_work > best.chain_work:
+                    best = orphan
+        return best
+
+    # Blocks off our tip are kept in the tree, their difficulty must follow from their
+    # ancestors so cheap side branches cannot fill it
+    def valid_side_difficulty(self, block, parent):
+        if parent is self.latest_block():
+            return True
+        return block.difficulty == self.next_difficulty(parent)
+
+    def add_orphan(self, block, block_hash):
+        self.orphans[block_hash] = block
+        self.orphans_by_parent.setdefault(block.previous_hash, set()).add(block_hash)
+        while len(self.orphans) > self.max_orphans:
+            oldest_hash, oldest = self.orphans.popitem(last=False)
+            self.forget_orphan(oldest_hash, oldest)
+
+    def pop_orphans(self, parent_hash):
+        orphans = []
+        for block_hash in self.orphans_by_parent.pop(parent_hash, ()):
+            orphans.append(self.orphans.pop(block_hash))
+        return orphans
+
+    def forget_orphan(self, block_hash, block):
+        siblings = self.orphans_by_parent.get(block.previous_hash)
+        if siblings is not None:
+            siblings.discard(block_hash)
+            if not siblings:
+                del self.orphans_by_parent[block.previous_hash]
+
+    # Reorganize to the branch ending in best in one step: undo our blocks above the
+    # fork point, connect the branch. A block failing validation is dropped from the
+    # tree with its descendants and the original chain is restored
+    def switch_to_branch(self, best):
+        branch = []
+        block = best
+        while block.compute_hash() not in self.block_hashes:
+            branch.append(block)
+            block = self.block_tree[block.previous_hash]
+        branch.reverse()
+        fork_position = block.index - self.chain[0].index + 1
+
+        disconnected = self.disconnect_blocks(fork_position)
+        for new_block in branch:
+            view = self.validate_transactions(new_block)
+            if view is None:
+                self.remove_from_tree(new_block)
+                rolled_back = self.disconnect_blocks(fork_position)
+                self.connect_blocks(disconnected) # back to the original chain
+                self.return_to_pool(rolled_back)
+                return False
+            self.connect_blocks([new_block], view)
+        self.break_mining = True
+        self.return_to_pool(disconnected)
         return True
 
-    def switch_to_original_chain(self, fork_index):
+    # transactions of disconnected blocks go back to the pool if still valid
+    def return_to_pool(self, blocks):
+        for block in blocks:
+            for tx in block.transactions:
+                if tx.inputs:
+                    self.receive_transaction(tx)
+
+    def tree_add(self, block):
+        block_hash = block.compute_hash()
+        self.block_tree[block_hash] = block
+        self.tree_children.setdefault(block.previous_hash, set()).add(block_hash)
+
+    # drops the block and its descendants
+    def remove_from_tree(self, block):
+        siblings = self.tree_children.get(block.previous_hash)
+        if siblings is not None:
+            siblings.discard(block.compute_hash())
+            if not siblings:
+                del self.tree_children[block.previous_hash]
+        pending = [block.compute_hash()]
+        while pending:
+            block_hash = pending.pop()
+            self.block_tree.pop(block_hash, None)
+            pending.extend(self.tree_children.pop(block_hash, ()))
+
+    # Check the block's transactions against an overlay of the UTXO set with all
+    # its inputs fetched in one batch, returns the view to flush or None
+    def validate_transactions(self, block):
+        view = CoinsView(self.utxos)
+        view.prefetch(block)
+        if not block.valid_transactions(view, self.verifier):
+            view.discard()
+            return None
+        return view
+
+    # view holds the already validated changes of a single block
+    def connect_blocks(self, blocks, view=None):
+        for block in blocks:
+            block.chain_work = self.calculate_cumulative_difficulty() + block_work(block)
+            self.chain.append(block)
+            self.block_hashes[block.compute_hash()] = block
+            self.tree_add(block)
+            self.update_utxos(block, view)
+            self.remove_confirmed_transactions(block.transactions)
+            view = None
+        if blocks:
+            self.storage_manager.blocks_connected(blocks)
+
+    # Pop blocks down to fork_index and undo their UTXO changes, returns them in chain order
+    def disconnect_blocks(self, fork_index):
+        disconnected = []
+        missing_undo = False
         while len(self.chain) > fork_index:
-            self.chain.pop()
+            block = self.chain.pop()
+            del self.block_hashes[block.compute_hash()]
+            if not missing_undo and not self.utxos.disconnect_block(block, block.compute_hash()):
+                missing_undo = True
+            disconnected.append(block)
+        if missing_undo: # blocks applied before undo data was recorded
+            self.rebuild_utxos()
+        disconnected.reverse()
+        if disconnected:
+            self.storage_manager.blocks_disconnected(disconnected)
+        return disconnected
 
     def rebuild_utxos(self):
-        self.utxos.flushdb()
+        self.utxos.reset()
         for block in self.chain:
             self.update_utxos(block)
 
     def receive_transaction(self, tx: Transaction):
-        # Validate transaction
+        # Known or double-spends a pool transaction
+        if tx.compute_txid() in self.unconfirmed_transactions \
+            or self.unconfirmed_transactions.conflicts(tx):
+            return False
+        # Validate transaction, inputs may spend outputs of pool transactions
         input_value = 0
         output_value = sum(output.amount for output in tx.outputs)
         for input in tx.inputs:
-            key = f"{input.prev_txid}:{input.vout}"
-            utxo_data = self.utxos[key]
-            if utxo_data is None:
+            utxo = self.utxos.get(input.prev_txid, input.vout) \
+                or self.unconfirmed_transactions.output((input.prev_txid, input.vout))
+            if utxo is None:
                 return False
-            utxo = json.loads(str(self.utxos.get(key)))
-            input_value += utxo["amount"]
-        if not tx.verify() or input_value < output_value:
+            input_value += utxo.amount
+        if not self.verify_transaction(tx) or input_value < output_value:
             return False
         
         # NOTE: this doesnt add to currently mined blockconsider
-        self.unconfirmed_transactions.append(tx)
-        return True
+        return self.unconfirmed_transactions.add(tx)
+
+    # verified signatures are remembered for when the transaction arrives in a block
+    def verify_transaction(self, tx: Transaction):
+        checks = tx.signature_checks()
+        return checks is not None and self.verifier.verify(checks)
 
     # Check if proof has the required number of leading zeros based on block difficulty
     def is_valid_proof(self, block, proof):
         target = "0" * block.difficulty
         return proof.startswith(target)
 
+    # Mine on all cores, receive_block stops the workers by setting break_mining
     def proof_of_work(self, block):
         self.break_mining = False
-        while not self.break_mining:
-            block.nonce += 1
-            guess = block.compute_hash()
-            target = "0" * block.difficulty
-            if guess[:block.difficulty] == target:
-                return guess
-
-    # find unspent utxo inputs for transaction
+        result = self.miner.mine(block, lambda: self.break_mining)
+        if result is None:
+            return None
+        block.nonce, guess = result
+        return guess
+
+    # find unspent utxo inputs for transaction, only the sender's coins are read
     def find_inputs(self, sender, amount):
         total_input_value = 0
         inputs = []
-        for key in self.utxos.scan_iter("utxo:*"):
-            utxo_data = self.utxos.get(key)
-            if utxo_data is not None:
-                utxo = json.loads(str(utxo_data))
-                if utxo['address'] == sender:
-                    total_input_value += utxo['amount']
-                    _, prev_txid, vout_str = key.decode('utf-8').split(':')
-                    inputs.append(Input(prev_txid, int(vout_str)))
-                    if total_input_value >= amount:
-                        break
+        for (prev_txid, vout), utxo in self.utxos.unspent(sender):
+            if self.unconfirmed_transactions.is_spent((prev_txid, vout)):
+                continue # already used by a pending transaction
+            total_input_value += utxo.amount
+            inputs.append(Input(prev_txid, vout))
+            if total_input_value >= amount:
+                break
         return (total_input_value, inputs)
 
-    def update_utxos(self, new_block: Block):
-        for tx in new_block.transactions:
-            # remove spent UTXOs
-            for input in tx.inputs:
-                key = f"{input.prev_txid}:{input.vout}"
-                self.utxos.delete(key)
-
-            # add new outputs
-            tx_id = tx.compute_txid()
-            for vout, output in enumerate(tx.outputs):
-                key = f"{tx_id}:{vout}"
-                self.utxos[key] = output
+    # applied atomically together with the best block marker
+    def update_utxos(self, new_block: Block, view: CoinsView = None):
+        expired = self.expired_undo(new_block)
+        if view is not None:
+            view.flush(new_block.compute_hash(), expired) # only the net delta is written
+        else:
+            self.utxos.apply_block(new_block, new_block.compute_hash(), expired)
+
+    # Hash of the main chain block whose undo data is dropped when new_block connects, or None
+    def expired_undo(self, new_block):
+        height = new_block.index - self.max_undo_depth
+        if not self.chain or height < self.chain[0].index:
+            return None
+        blocks = self.block_range(height, 1)
+        return blocks[0].compute_hash() if blocks else None
 
     def get_balance(self, address):
-        balance = 0
-        for key in self.utxos.scan_iter("utxo:*"):
-            utxo_data = self.utxos.get(key)
-            if utxo_data is not None:
-                utxo = json.loads(str(utxo_data))
-                if utxo['address'] == address:
-                    balance += utxo['amount']
-        return balance
+        return self.utxos.balance(address)
 
     def create_coinbase_transaction(self, recipient, amount, index):
         outputs = [Output(recipient, amount)]
-        tx = Transaction([], outputs, index)
-        self.unconfirmed_transactions.insert(0, tx) # first
-        return tx
+        return Transaction([], outputs, index)
 
     # Create and add UTXO transaction with inputs, outputs 
     def create_transaction(self, sender, recipient, amount, sender_private_key):
@@ -250,8 +415,7 @@ class Blockchain:
 
         transaction = Transaction(inputs, outputs)
         transaction.sign(sender_private_key)
-        if transaction.verify():
-            self.unconfirmed_transactions.append(transaction)
+        if self.verify_transaction(transaction) and self.unconfirmed_transactions.add(transaction):
             self.node.new_transaction(transaction)
             self.storage_manager.store_transaction(transaction)
             return transaction
@@ -259,26 +423,29 @@ class Blockchain:
 
     # update uncormined transactions after new block
     def remove_confirmed_transactions(self, confirmed_transactions):
-        confirmed_txids = {tx.compute_txid() for tx in confirmed_transactions}
-        self.unconfirmed_transactions = [tx for tx in self.unconfirmed_transactions if tx.compute_txid() not in confirmed_txids]
+        self.unconfirmed_transactions.remove_block(confirmed_transactions)
 
-    def mine(self, miner_address):
+    # Next block on our tip, transactions are a bounded snapshot of the mempool
+    # so pool changes while mining do not alter the block
+    def build_block_template(self, miner_address):
         last_block = self.chain[-1]
-        self.create_coinbase_transaction(miner_address, 1, last_block.index + 1)  # Reward the miner
-        new_block = Block(
+        coinbase = self.create_coinbase_transaction(miner_address, 1, last_block.index + 1)  # Reward the miner
+        transactions = self.unconfirmed_transactions.select(self.max_block_bytes, self.max_block_txs)
+        return Block(
             index=last_block.index + 1,
             previous_hash=last_block.compute_hash(),
-            transactions=self.unconfirmed_transactions,
+            transactions=[coinbase] + transactions, # coinbase first
             timestamp=int(time.time()),
             nonce=0,
             difficulty=self.dynamic_difficulty(), # by average time of last 20 blocks
         )
+
+    def mine(self, miner_address):
+        new_block = self.build_block_template(miner_address)
         proof = self.proof_of_work(new_block)
 
         if proof:
-            self.chain.append(new_block) # add mined block
-            self.update_utxos(new_block)
-            self.remove_confirmed_transactions(new_block.transactions)
+            self.connect_blocks([new_block]) # add mined block
             self.node.new_block(new_block) # transmit block to peers
         return new_block.index
 
@@ -293,37 +460,101 @@ class Blockchain:
     # update difficulty to take 1 minute to mine block
     # decide according to last 20 blocks
     def dynamic_difficulty(self):
-        if len(self.chain) > 20:
-            actual_time_diff = self.chain[-1].timestamp - self.chain[-21].timestamp
-            old_difficulty = self.chain[-1].difficulty
-            estimated_time_diff = 1200 # 1 minute
+        return self.next_difficulty(self.chain[-1])
+
+    # difficulty of a block following parent, on any branch of the tree
+    def next_difficulty(self, parent):
+        # 20 blocks back from parent, fewer than 21 blocks keep the initial difficulty
+        first = parent
+        for _ in range(20):
+            first = self.block_tree.get(first.previous_hash)
+            if first is None:
+                return self.difficulty
+
+        actual_time_diff = parent.timestamp - first.timestamp
+        old_difficulty = parent.difficulty
+        estimated_time_diff = 1200 # 1 minute
 
-            if actual_time_diff == 0:
-                actual_time_diff = 1
-            new_difficulty = old_difficulty * estimated_time_diff // actual_time_diff
+        if actual_time_diff == 0:
+            actual_time_diff = 1
+        new_difficulty = old_difficulty * estimated_time_diff // actual_time_diff
 
-            return max(new_difficulty, 1)
-        return self.difficulty
+        return max(new_difficulty, 1)
 
+    # cached on the tip, O(1)
     def calculate_cumulative_difficulty(self):
-        cumulative_difficulty = 0
-        for block in self.chain:
-            cumulative_difficulty += 2 ** block.difficulty
-        return cumulative_difficulty
+        if len(self.chain) == 0:
+            return 0
+        return self.chain[-1].chain_work
 
     def load_blockchain(self):
         chain = self.storage_manager.load_blockchain_data()
         if chain:
             self.chain = chain
-        self.unconfirmed_transactions = self.storage_manager.load_all_transactions()
+            self.block_hashes = {block.compute_hash(): block for block in chain}
+            self.block_tree = {}
+            self.tree_children = {}
+            for block in chain:
+                self.tree_add(block)
+            chain_work = 0
+            for block in chain:
+                chain_work += block_work(block)
+                block.chain_work = chain_work
+            # UTXO set was left at another block (e.g. crash before saving the chain)
+            if self.utxos.best_block() != self.latest_block().compute_hash():
+                self.rebuild_utxos()
+        self.unconfirmed_transactions = Mempool()
+        for tx in self.storage_manager.load_all_transactions():
+            self.receive_transaction(tx) # confirmed or invalid ones are dropped
 
     def quit(self):
+        self.miner.close()
+        self.verifier.close()
         self.node.close()
-        self.storage_manager.store_blockchain_data(self) # save to MongoDB
+        self.storage_manager.store_blockchain_data(self) # write blocks still pending to MongoDB
         self.storage_manager.close_connection()
+        self.utxos.close()
 
     def latest_block(self):
         if len(self.chain) == 0:
             return None
         return self.chain[-1]
 
+    # blocks start..start+count-1 of our chain, fewer if the chain is shorter
+    def block_range(self, start, count):
+        if not self.chain:
+            return []
+        offset = max(start - self.chain[0].index, 0)
+        return list(itertools.islice(self.chain, offset, offset + max(count, 0)))
+
+    # codec encoding of the main chain block at a height if the store keeps it, else None
+    def read_block_data(self, index):
+        return self.storage_manager.read_block_data(index)
+
+    # any known block, side branches included
+    def get_block(self, block_hash):
+        return self.block_tree.get(block_hash)
+
+    # Hashes from the tip back to genesis: the last LOCATOR_DENSE blocks, then doubling steps.
+    # O(log height) entries, a peer finds the fork point with one lookup per entry
+    def block_locator(self):
+        locator = []
+        position = len(self.chain) - 1
+        step = 1
+        while position > 0:
+            locator.append(self.chain[position].compute_hash())
+            if len(locator) >= LOCATOR_DENSE:
+                step *= 2
+            position -= step
+        if self.chain:
+            locator.append(self.chain[0].compute_hash())
+        return locator
+
+    # Last block of ours in the peer's locator (the fork point) or None
+    def find_fork(self, locator):
+        for block_hash in locator:
+            block = self.block_hashes.get(block_hash)
+            if block is not None:
+                return block
+        return None
+
@@ -0,0 +1,133 @@
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from functions import hash_to_bytes
+from codec import encode_block, decode_block
+
+"""
+    Embedded block store for nodes without MongoDB, a drop-in for StorageManager.
+    blocks.dat: the codec encoding of every connected block, appended.
+    index.dat: block count, then one fixed-width record per height of the main
+    chain (hash, offset and length in blocks.dat). The index is memory-mapped
+    when the store opens and the hash -> height map is built from it, so opening
+    reads the index only. A block is read back with a single pread.
+    A reorg only shortens the index, blocks of the old branch stay in the data
+    file. A stored height is never overwritten, the blocks above the fork
+    point are disconnected first. Unconfirmed transactions are not persisted.
+"""
+
+BLOCK_STORE_DIR = 'blocks'
+DATA_FILE = 'blocks.dat'
+INDEX_FILE = 'index.dat'
+INDEX_HEADER = struct.Struct('>Q') # number of indexed blocks
+INDEX_RECORD = struct.Struct('>32sQI') # hash, offset, length
+INDEX_GROWTH = 4096 # records the index file grows by
+
+class FlatFileBlockStore:
+    def __init__(self, directory=BLOCK_STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.data_fd = os.open(os.path.join(directory, DATA_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        self.index_fd = os.open(os.path.join(directory, INDEX_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.index_fd).st_size < INDEX_HEADER.size:
+            os.ftruncate(self.index_fd, INDEX_HEADER.size + INDEX_GROWTH * INDEX_RECORD.size)
+        self.index = mmap.mmap(self.index_fd, 0)
+        (self.count,) = INDEX_HEADER.unpack_from(self.index, 0)
+
+        self.heights = {} # hash -> height
+        self.data_end = 0 # data after the last indexed block is left from a crash and overwritten
+        for height in range(self.count):
+            block_hash, offset, length = self.record(height)
+            self.heights[block_hash.hex()] = height
+            self.data_end = offset + length
+
+    def __len__(self):
+        return self.count
+
+    def record(self, height):
+        return INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + height * INDEX_RECORD.size)
+
+    def set_count(self, count):
+        for height in range(count, self.count):
+            self.heights.pop(self.record(height)[0].hex(), None)
+        self.count = count
+        INDEX_HEADER.pack_into(self.index, 0, count)
+
+    def append(self, block):
+        height = block.index
+        block_hash = block.compute_hash()
+        if height < self.count:
+            if self.record(height)[0] == hash_to_bytes(block_hash):
+                return # already stored
+            raise ValueError(f'Block {height} is already stored, disconnect the blocks from {height} first')
+        if height > self.count:
+            raise ValueError(f'Block {height} does not follow the {self.count} stored blocks')
+
+        data = encode_block(block)
+        position = INDEX_HEADER.size + height * INDEX_RECORD.size
+        if position + INDEX_RECORD.size > len(self.index):
+            os.ftruncate(self.index_fd, len(self.index) + INDEX_GROWTH * INDEX_RECORD.size)
+            self.index.resize(os.fstat(self.index_fd).st_size)
+
+        os.pwrite(self.data_fd, data, self.data_end)
+        INDEX_RECORD.pack_into(self.index, position, hash_to_bytes(block_hash), self.data_end, len(data))
+        self.data_end += len(data)
+        self.heights[block_hash] = height
+        self.set_count(height + 1)
+
+    # same hooks as StorageManager, called by the blockchain as blocks are connected and disconnected
+    def blocks_connected(self, blocks):
+        with self.lock:
+            for block in blocks:
+                self.append(block)
+
+    def blocks_disconnected(self, blocks):
+        with self.lock:
+            self.set_count(min(self.count, min(block.index for block in blocks)))
+
+    # Encoded block of the main chain at a height, one pread
+    def read_block_data(self, height):
+        if not 0 <= height < self.count:
+            return None
+        _, offset, length = self.record(height)
+        return os.pread(self.data_fd, length, offset)
+
+    def get_block(self, block_hash):
+        height = self.heights.get(block_hash)
+        return None if height is None else decode_block(self.read_block_data(height))
+
+    def load_blockchain_data(self):
+        chain = deque(decode_block(self.read_block_data(height)) for height in range(self.count))
+        return chain if chain else None
+
+    # Blocks are written as they are connected, stores what is missing (e.g. a chain
+    # created before the store was used) and syncs both files to disk
+    def store_blockchain_data(self, blockchain):
+        with self.lock:
+            for block in list(blockchain.chain)[self.count:]:
+                self.append(block)
+            self.index.flush()
+            os.fsync(self.data_fd)
+        print("Blockchain data stored successfully.")
+
+    def store_transaction(self, transaction):
+        pass
+
+    def load_all_transactions(self):
+        return []
+
+    def print_blockchain_data(self, limit=None):
+        print("Blockchain data from block store:")
+        for height in range(min(self.count, limit or self.count)):
+            block = decode_block(self.read_block_data(height))
+            print(f"{height}: {block.compute_hash()} ({len(block.transactions)} transactions)")
+
+    def close_connection(self):
+        with self.lock:
+            self.index.flush()
+            os.fsync(self.data_fd)
+            self.index.close()
+            os.close(self.index_fd)
+            os.close(self.data_fd)
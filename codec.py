@@ -0,0 +1,203 @@
+import hashlib
+import struct
+from transaction import Input, Output, Transaction
+from blockchain import Block, HEADER_FORMAT
+from functions import NONCE_FORMAT, hash_to_bytes, hash_with_nonce
+
+"""
+    Versioned binary wire encoding of blocks and transactions.
+    Block: version, header (index, previous_hash, merkle_root, timestamp,
+    difficulty), nonce, transaction count, transactions.
+    Transaction: index, inputs (prev_txid, vout, signature, public_key),
+    outputs (address, amount). Integers are big-endian, strings and byte
+    strings are prefixed with a 2-byte length. Block ranges and header lists
+    are a 4-byte count followed by the items. Only plain values are decoded,
+    no Python types are reconstructed from the data.
+"""
+
+CODEC_VERSION = 1
+VERSION = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+AMOUNT = struct.Struct('>d')
+TX_HEADER = struct.Struct('>IH') # index, input count
+
+def pack_blob(data: bytes) -> bytes:
+    return U16.pack(len(data)) + data
+
+def hex_to_blob(value):
+    return pack_blob(bytes.fromhex(value) if value else b'')
+
+class Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt: struct.Struct):
+        if self.offset + fmt.size > len(self.data):
+            raise ValueError('Truncated data')
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def bytes(self, length) -> bytes:
+        end = self.offset + length
+        if end > len(self.data):
+            raise ValueError('Truncated data')
+        value = bytes(self.data[self.offset:end])
+        self.offset = end
+        return value
+
+    def blob(self) -> bytes:
+        (length,) = self.unpack(U16)
+        return self.bytes(length)
+
+    def string(self):
+        return self.blob().decode()
+
+    def hex_or_none(self):
+        value = self.blob()
+        return value.hex() if value else None
+
+    def check_version(self):
+        (version,) = self.unpack(VERSION)
+        if version != CODEC_VERSION:
+            raise ValueError(f'Unsupported codec version {version}')
+
+    def finish(self):
+        if self.offset != len(self.data):
+            raise ValueError('Trailing data')
+
+
+def write_transaction(parts, tx: Transaction):
+    parts.append(TX_HEADER.pack(tx.index, len(tx.inputs)))
+    for input in tx.inputs:
+        parts.append(input.serialize())
+        parts.append(hex_to_blob(input.signature))
+        parts.append(hex_to_blob(input.public_key))
+    parts.append(U16.pack(len(tx.outputs)))
+    for output in tx.outputs:
+        parts.append(output.serialize())
+
+def read_transaction(reader: Reader) -> Transaction:
+    index, input_count = reader.unpack(TX_HEADER)
+    inputs = []
+    for _ in range(input_count):
+        prev_txid = reader.string()
+        (vout,) = reader.unpack(U32)
+        input = Input(prev_txid, vout)
+        input.signature = reader.hex_or_none()
+        input.public_key = reader.hex_or_none()
+        inputs.append(input)
+    (output_count,) = reader.unpack(U16)
+    outputs = []
+    for _ in range(output_count):
+        address = reader.string()
+        (amount,) = reader.unpack(AMOUNT)
+        outputs.append(Output(address, amount))
+    return Transaction(inputs, outputs, index)
+
+def encode_transaction(tx: Transaction) -> bytes:
+    parts = [VERSION.pack(CODEC_VERSION)]
+    write_transaction(parts, tx)
+    return b''.join(parts)
+
+def decode_transaction(data) -> Transaction:
+    reader = Reader(data)
+    reader.check_version()
+    tx = read_transaction(reader)
+    reader.finish()
+    return tx
+
+def write_block(parts, block: Block):
+    parts.append(block.header_prefix())
+    parts.append(NONCE_FORMAT.pack(block.nonce))
+    parts.append(U32.pack(len(block.transactions)))
+    for tx in block.transactions:
+        write_transaction(parts, tx)
+
+# The merkle root is recomputed from the transactions, a mismatch means a corrupt block
+def read_block(reader: Reader) -> Block:
+    index, previous_hash, merkle_root, timestamp, difficulty = reader.unpack(HEADER_FORMAT)
+    (nonce,) = reader.unpack(NONCE_FORMAT)
+    (tx_count,) = reader.unpack(U32)
+    transactions = [read_transaction(reader) for _ in range(tx_count)]
+
+    block = Block(index, previous_hash.hex(), transactions, timestamp, nonce, difficulty)
+    if hash_to_bytes(block.merkle_root) != merkle_root:
+        raise ValueError('Merkle root does not match transactions')
+    return block
+
+def encode_block(block: Block) -> bytes:
+    parts = [VERSION.pack(CODEC_VERSION)]
+    write_block(parts, block)
+    return b''.join(parts)
+
+def decode_block(data) -> Block:
+    reader = Reader(data)
+    reader.check_version()
+    block = read_block(reader)
+    reader.finish()
+    return block
+
+# Consecutive blocks in one message
+# Stops before the block that would take the encoding over max_bytes, the first block always goes in
+def encode_blocks(blocks, max_bytes=None) -> bytes:
+    parts = []
+    size = VERSION.size + U32.size
+    count = 0
+    for block in blocks:
+        block_parts = []
+        write_block(block_parts, block)
+        block_size = sum(len(part) for part in block_parts)
+        if max_bytes is not None and count and size + block_size > max_bytes:
+            break
+        parts.extend(block_parts)
+        size += block_size
+        count += 1
+    return b''.join([VERSION.pack(CODEC_VERSION), U32.pack(count)] + parts)
+
+def decode_blocks(data):
+    reader = Reader(data)
+    reader.check_version()
+    (count,) = reader.unpack(U32)
+    blocks = [read_block(reader) for _ in range(count)]
+    reader.finish()
+    return blocks
+
+
+# Headers without transactions: the HEADER_FORMAT fields and the nonce
+class BlockHeader:
+    def __init__(self, fields, nonce):
+        self.fields = fields # index, previous_hash, merkle_root, timestamp, difficulty
+        self.nonce = nonce
+        self.index = fields[0]
+        self.previous_hash = fields[1].hex()
+        self.difficulty = fields[4]
+        self.hash = header_hash(fields, nonce)
+
+    @staticmethod
+    def from_block(block: Block):
+        return BlockHeader(HEADER_FORMAT.unpack(block.header_prefix()), block.nonce)
+
+def header_hash(fields, nonce):
+    return hash_with_nonce(hashlib.sha256(HEADER_FORMAT.pack(*fields)), nonce)
+
+def encode_headers(blocks) -> bytes:
+    parts = [VERSION.pack(CODEC_VERSION), U32.pack(len(blocks))]
+    for block in blocks:
+        parts.append(block.header_prefix())
+        parts.append(NONCE_FORMAT.pack(block.nonce))
+    return b''.join(parts)
+
+def decode_headers(data):
+    reader = Reader(data)
+    reader.check_version()
+    (count,) = reader.unpack(U32)
+    headers = []
+    for _ in range(count):
+        fields = reader.unpack(HEADER_FORMAT)
+        (nonce,) = reader.unpack(NONCE_FORMAT)
+        headers.append(BlockHeader(fields, nonce))
+    reader.finish()
+    return headers
@@ -0,0 +1,114 @@
+import hashlib
+from blockchain import Block, HEADER_FORMAT
+from functions import NONCE_FORMAT, hash_to_bytes
+from codec import header_hash, Reader, VERSION, CODEC_VERSION, U16, U32, write_transaction, read_transaction
+
+"""
+    Compact blocks: the header and nonce, the coinbase and a 6-byte short ID
+    for every other transaction. The receiver rebuilds the block from its
+    mempool and asks only for the transactions it is missing.
+    Short IDs are keyed with the block hash, a collision in one block does
+    not repeat in the next.
+"""
+
+SHORT_ID_SIZE = 6
+PREFILLED = 1 # leading transactions sent in full: the coinbase
+MAX_PENDING_BLOCKS = 16 # compact blocks waiting for missing transactions
+
+def short_id(key: bytes, txid) -> bytes:
+    return hashlib.sha256(key + bytes.fromhex(txid)).digest()[:SHORT_ID_SIZE]
+
+
+class CompactBlock:
+    def __init__(self, header, nonce, block_hash, short_ids, prefilled):
+        self.header = header # (index, previous_hash, merkle_root, timestamp, difficulty) as packed
+        self.nonce = nonce
+        self.block_hash = block_hash
+        self.short_ids = short_ids
+        self.prefilled = prefilled # leading transactions
+        self.transactions = prefilled + [None] * len(short_ids) # None until found
+
+    @staticmethod
+    def from_block(block: Block):
+        block_hash = block.compute_hash()
+        key = hash_to_bytes(block_hash)
+        header = HEADER_FORMAT.unpack(block.header_prefix())
+        short_ids = [short_id(key, tx.compute_txid()) for tx in block.transactions[PREFILLED:]]
+        return CompactBlock(header, block.nonce, block_hash, short_ids, block.transactions[:PREFILLED])
+
+    def encode(self) -> bytes:
+        parts = [VERSION.pack(CODEC_VERSION), HEADER_FORMAT.pack(*self.header), NONCE_FORMAT.pack(self.nonce),
+                 U16.pack(len(self.prefilled))]
+        for tx in self.prefilled:
+            write_transaction(parts, tx)
+        parts.append(U32.pack(len(self.short_ids)))
+        parts.extend(self.short_ids)
+        return b''.join(parts)
+
+    @staticmethod
+    def decode(data):
+        reader = Reader(data)
+        reader.check_version()
+        header = reader.unpack(HEADER_FORMAT)
+        (nonce,) = reader.unpack(NONCE_FORMAT)
+        (prefilled_count,) = reader.unpack(U16)
+        prefilled = [read_transaction(reader) for _ in range(prefilled_count)]
+        (count,) = reader.unpack(U32)
+        short_ids = [reader.bytes(SHORT_ID_SIZE) for _ in range(count)]
+        reader.finish()
+
+        # the block hash only depends on the header, it keys the short IDs
+        block_hash = header_hash(header, nonce)
+        return CompactBlock(header, nonce, block_hash, short_ids, prefilled)
+
+    # Fill in transactions from the pool, returns the positions still missing.
+    # Short IDs matching several pool transactions are left missing
+    def fill_from(self, transactions):
+        key = hash_to_bytes(self.block_hash)
+        wanted = {}
+        for position, sid in enumerate(self.short_ids, len(self.prefilled)):
+            if self.transactions[position] is None:
+                wanted.setdefault(sid, []).append(position)
+        found = {}
+        for tx in transactions:
+            sid = short_id(key, tx.compute_txid())
+            if sid in wanted:
+                found[sid] = None if sid in found else tx
+        for sid, tx in found.items():
+            if tx is not None and len(wanted[sid]) == 1:
+                self.transactions[wanted[sid][0]] = tx
+        return self.missing()
+
+    def missing(self):
+        return [position for position, tx in enumerate(self.transactions) if tx is None]
+
+    def fill_missing(self, positions, transactions):
+        if len(positions) != len(transactions):
+            raise ValueError('Transaction count does not match the request')
+        for position, tx in zip(positions, transactions):
+            self.transactions[position] = tx
+
+    # None if the transactions don't match the header (e.g. a short ID collision)
+    def to_block(self):
+        index, previous_hash, merkle_root, timestamp, difficulty = self.header
+        block = Block(index, previous_hash.hex(), list(self.transactions), timestamp, self.nonce, difficulty)
+        if hash_to_bytes(block.merkle_root) != merkle_root:
+            return None
+        return block
+
+
+# BLOCKTXN payload: block hash, then the requested transactions in order
+def encode_block_transactions(block_hash, transactions) -> bytes:
+    parts = [VERSION.pack(CODEC_VERSION), hash_to_bytes(block_hash), U32.pack(len(transactions))]
+    for tx in transactions:
+        write_transaction(parts, tx)
+    return b''.join(parts)
+
+def decode_block_transactions(data):
+    reader = Reader(data)
+    reader.check_version()
+    block_hash = reader.bytes(32).hex()
+    (count,) = reader.unpack(U32)
+    transactions = [read_transaction(reader) for _ in range(count)]
+    reader.finish()
+    return block_hash, transactions
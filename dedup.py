@@ -0,0 +1,88 @@
+import math
+import threading
+import time
+
+"""
+    Fixed-memory de-duplication of relayed messages: a pair of Bloom filters.
+    New IDs go into the current filter, lookups check both. When the current
+    filter has been filling for a generation (or holds its capacity) it
+    becomes the previous one and the old previous filter is dropped, so an ID
+    is remembered for one to two generations.
+    IDs are SHA-256 digests, the bit positions are taken from their last
+    bytes (block hashes start with zero bytes).
+"""
+
+FILTER_BITS = 1 << 20 # 128 KiB per filter
+FILTER_HASHES = 4
+FILTER_CAPACITY = 50000 # IDs per generation, about 0.1% false positives when full
+GENERATION_TIME = 300 # seconds
+
+class BloomFilter:
+    def __init__(self, bits=FILTER_BITS, hashes=FILTER_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray(bits // 8)
+        self.count = 0
+
+    def positions(self, digest: bytes):
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[-4 * i - 4:len(digest) - 4 * i], 'big') % self.bits
+
+    def __contains__(self, digest):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self.positions(digest))
+
+    def add(self, digest):
+        for p in self.positions(digest):
+            self.array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    # probability that an ID never added is reported as present
+    def false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+
+class MessageFilter:
+    def __init__(self, bits=FILTER_BITS, hashes=FILTER_HASHES, capacity=FILTER_CAPACITY,
+                 generation_time=GENERATION_TIME):
+        self.bits = bits
+        self.hashes = hashes
+        self.capacity = capacity
+        self.generation_time = generation_time
+        self.current = BloomFilter(bits, hashes)
+        self.previous = BloomFilter(bits, hashes)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rotations = 0
+
+    def __contains__(self, digest):
+        with self.lock:
+            self.rotate()
+            if digest in self.current or digest in self.previous:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, digest):
+        with self.lock:
+            self.rotate()
+            self.current.add(digest)
+
+    def rotate(self, now=None):
+        now = now or time.time()
+        if now - self.started >= self.generation_time or self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.bits, self.hashes)
+            self.started = now
+            self.rotations += 1
+
+    # chance that a new message is wrongly taken for a duplicate
+    def false_positive_rate(self):
+        current, previous = self.current.false_positive_rate(), self.previous.false_positive_rate()
+        return 1 - (1 - current) * (1 - previous)
+
+    # expected number of hits that were false positives
+    def false_positives(self):
+        return self.misses * self.false_positive_rate()
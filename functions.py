@@ -1,5 +1,6 @@
 import hashlib
 import os
+import struct
 import ecdsa
 import base58
 
@@ -25,3 +26,25 @@ def derive_public_key(private_key):
     sk = ecdsa.SigningKey.from_string(private_key, curve=ecdsa.SECP256k1)
     return b'\x04' + sk.verifying_key.to_string()  # prefix for uncompressed public key 
 
+
+NONCE_FORMAT = struct.Struct('>Q')
+
+# Fixed 32-byte form of a hex hash, short values like the genesis "0" are left padded
+def hash_to_bytes(hex_hash):
+    return bytes.fromhex(hex_hash.rjust(64, '0'))
+
+# 64 hex digits, the form of every block hash and txid
+def is_hash(value):
+    if not isinstance(value, str) or len(value) != 64:
+        return False
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return False
+    return True
+
+# Finish a double SHA-256 from the hashed constant prefix (midstate) and a nonce
+def hash_with_nonce(midstate, nonce):
+    inner = midstate.copy()
+    inner.update(NONCE_FORMAT.pack(nonce))
+    return hashlib.sha256(inner.digest()).hexdigest()
@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+    Inventory relay: new blocks and transactions are announced by hash (INV),
+    peers request the bodies they don't have (GETDATA). Each peer keeps a
+    bounded set of the inventory it is known to have, so nothing is announced
+    or sent back to a peer that already announced it to us.
+    Inventory items are [kind, hash] lists with kind 'tx' or 'block'.
+"""
+
+INV_TX = 'tx'
+INV_BLOCK = 'block'
+MAX_KNOWN_INVENTORY = 5000 # per peer
+MAX_INV_ITEMS = 1000 # per INV/GETDATA message
+REQUEST_TIMEOUT = 30 # seconds before an item may be requested from another peer
+
+# Bounded set, the oldest items are forgotten first
+class InventorySet:
+    def __init__(self, max_size=MAX_KNOWN_INVENTORY):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        with self.lock:
+            self.items[item] = None
+            self.items.move_to_end(item)
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+# Items requested with GETDATA and not received yet, so each one is fetched from a single peer
+class RequestTracker:
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self.requested = OrderedDict() # item -> time requested, oldest first
+        self.lock = threading.Lock()
+
+    # True if the item should be requested now
+    def request(self, item, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.expire(now)
+            if item in self.requested:
+                return False
+            self.requested[item] = now
+            return True
+
+    def received(self, item):
+        with self.lock:
+            self.requested.pop(item, None)
+
+    def expire(self, now):
+        while self.requested:
+            item, requested_at = next(iter(self.requested.items()))
+            if requested_at > now - self.timeout:
+                break
+            del self.requested[item]
@@ -1,7 +1,10 @@
 from blockchain import Blockchain
 from functions import *
 from storage import StorageManager
+from blockstore import FlatFileBlockStore
+from utxo import open_utxo_store
 from node import Node, threading
+from async_node import AsyncNode
 import unittest
 import time
 import jsonpickle
@@ -10,29 +13,33 @@ from wallet import *
 
 HOST='127.0.0.1' # local for testing
 SEED_NODES = [('127.0.0.1', 6005)] # can be multiple ones
+NODE_CLASS = AsyncNode # or Node for a thread per connection
+BLOCK_STORE_DIR = None # directory for a flat-file block store instead of MongoDB, e.g. 'blocks'
+UTXO_BACKEND = 'redis' # UTXO set: 'redis', 'sqlite' (embedded file) or 'memory' (lost on exit)
     
 class BlockchainCLI:
     def __init__(self):
-        self.storage_manager = StorageManager()
+        self.storage_manager = FlatFileBlockStore(BLOCK_STORE_DIR) if BLOCK_STORE_DIR else StorageManager()
 
         # decide how to connect to network
         seed_node = input('Start seed node or normal node? (s/n)') == 's'
         if seed_node:
-            self.node = Node(*SEED_NODES[0]) # start seed node
+            self.node = NODE_CLASS(*SEED_NODES[0]) # start seed node
         else:
-            self.node = Node(HOST, int(input('Port: ')))
+            self.node = NODE_CLASS(HOST, int(input('Port: ')))
             for seed in SEED_NODES:
                 try:
                     self.node.connect_to_peer(*seed)
                 except Exception as e:
                     print(f'Error connecting to seed node: {e}')
         
-        self.blockchain = Blockchain(self.node)
+        self.blockchain = Blockchain(self.node, utxos=open_utxo_store(UTXO_BACKEND), storage=self.storage_manager)
+        self.blockchain.load_blockchain() # continue from the stored chain
         self.wallet = Wallet(self.blockchain)
         self.mine = False
 
         # NEED TO BE CREATED ONLY ONCE -> then shared to other nodes
-        if seed_node:
+        if seed_node and not self.blockchain.chain:
             self.blockchain.create_genesis_block(difficulty=4) # Set the initial difficulty for the genesis block
 
     def show_transactions(self):
@@ -82,6 +89,8 @@ class BlockchainCLI:
         print("Mining new block...")
         new_block_index = self.blockchain.mine(self.miner_address)
         print(f"Block #{new_block_index} mined.")
+        for worker_id, rate in sorted(self.blockchain.miner.hashrates.items()):
+            print(f"  Worker {worker_id}: {rate:.0f} H/s")
 
     def mining_thread(self):
         while True: 
@@ -156,32 +165,37 @@ class BlockchainCLI:
                 elif choice == '3':
                     self.print_miner_address()
                 elif choice == '4':
-                    self.storage_manager.store_blockchain_data(self.blockchain)
+                    self.blockchain.storage_manager.store_blockchain_data(self.blockchain)
                     limit = int(input("Enter the limit for printing blockchain data: "))
                     self.storage_manager.print_blockchain_data(limit)
                 elif choice == '5':
                     print("\nChoose an option:")
                     print("1. Print peer list")
-                    choice = input("Enter your choice (1-1): ")
+                    print("2. Print send queue depths")
+                    print("3. Print relay filter stats")
+                    choice = input("Enter your choice (1-3): ")
                     match choice:
                         case '1':
                             data = list(self.blockchain.node.listen_ports.values())
                             print(jsonpickle.encode(data, indent=2))
+                        case '2':
+                            for address, depth in self.blockchain.node.queue_depths().items():
+                                print(f"{address}: {depth['frames']} frames, {depth['bytes']} bytes, {depth['dropped']} dropped")
+                        case '3':
+                            seen = self.blockchain.node.processed_items
+                            print(f"{seen.hits} duplicates, {seen.misses} new, {seen.rotations} rotations")
+                            print(f"False positive rate {seen.false_positive_rate():.4%}, about {seen.false_positives():.1f} so far")
                         case _:
                             print("Invalid choice")
                 elif choice == '6':
                     utxos = []
-                    for key in self.blockchain.utxos.scan_iter("utxo:*"):
-                        utxo_data = str(self.blockchain.utxos.get(key))
-                        if utxo_data is not None:
-                            utxo = json.loads(utxo_data)
-                            _, prev_txid, vout_str = key.decode('utf-8').split(':')
-                            utxos.append({
-                                'tx_id': prev_txid,
-                                'vout': int(vout_str),
-                                'address': utxo['address'],
-                                'amount': utxo['amount']
-                            })
+                    for (prev_txid, vout), utxo in self.blockchain.utxos.unspent():
+                        utxos.append({
+                            'tx_id': prev_txid,
+                            'vout': vout,
+                            'address': utxo.address,
+                            'amount': utxo.amount
+                        })
                     print(json.dumps(utxos, indent=2))
                 elif choice == '7':
                    self.mine = not self.mine 
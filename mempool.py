@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+    Pool of unconfirmed transactions indexed by txid and by the outpoints
+    they spend, bounded in size and age
+"""
+
+MAX_MEMPOOL_BYTES = 5_000_000
+MEMPOOL_EXPIRY = 24 * 3600 # seconds a transaction may wait for a block
+MAX_BLOCK_BYTES = 1_000_000 # limits of a block template, coinbase excluded
+MAX_BLOCK_TXS = 2000
+
+# Approximate wire size: canonical encoding plus signatures and public keys
+def transaction_size(tx) -> int:
+    size = len(tx.serialize())
+    for input in tx.inputs:
+        size += (len(input.signature or '') + len(input.public_key or '')) // 2
+    return size
+
+
+class MempoolEntry:
+    def __init__(self, tx, size, time_added):
+        self.tx = tx
+        self.size = size
+        self.time_added = time_added
+
+
+class Mempool:
+    def __init__(self, max_bytes=MAX_MEMPOOL_BYTES, expiry=MEMPOOL_EXPIRY):
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.entries = OrderedDict() # txid -> entry, oldest first
+        self.spent = {} # (txid, vout) -> txid of the mempool transaction spending it
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    # snapshot in arrival order
+    def __iter__(self):
+        with self.lock:
+            return iter([entry.tx for entry in self.entries.values()])
+
+    def get(self, txid):
+        entry = self.entries.get(txid)
+        return entry.tx if entry else None
+
+    # output of a pool transaction, None if there is none
+    def output(self, outpoint):
+        txid, vout = outpoint
+        entry = self.entries.get(txid)
+        if entry is None or not 0 <= vout < len(entry.tx.outputs):
+            return None
+        return entry.tx.outputs[vout]
+
+    def is_spent(self, outpoint):
+        return outpoint in self.spent
+
+    def conflicts(self, tx):
+        return any((input.prev_txid, input.vout) in self.spent for input in tx.inputs)
+
+    # False for duplicates and double-spends of mempool transactions
+    def add(self, tx) -> bool:
+        txid = tx.compute_txid()
+        with self.lock:
+            if txid in self.entries or self.conflicts(tx):
+                return False
+            entry = MempoolEntry(tx, transaction_size(tx), time.time())
+            self.entries[txid] = entry
+            for input in tx.inputs:
+                self.spent[(input.prev_txid, input.vout)] = txid
+            self.size += entry.size
+
+            self.expire()
+            self.evict()
+            return txid in self.entries
+
+    # Removes the transaction and, unless it was confirmed, everything spending its outputs.
+    # Children of a confirmed transaction spend confirmed outputs and stay
+    def remove(self, txid, descendants=True):
+        with self.lock:
+            entry = self.entries.pop(txid, None)
+            if entry is None:
+                return
+            self.size -= entry.size
+            for input in entry.tx.inputs:
+                self.spent.pop((input.prev_txid, input.vout), None)
+            if not descendants:
+                return
+            for vout in range(len(entry.tx.outputs)):
+                child = self.spent.get((txid, vout))
+                if child is not None:
+                    self.remove(child)
+
+    # O(transactions in the block): confirmed ones and the ones they conflict with
+    def remove_block(self, transactions):
+        with self.lock:
+            for tx in transactions:
+                txid = tx.compute_txid()
+                if txid in self.entries:
+                    self.remove(txid, descendants=False)
+                    continue
+                for input in tx.inputs:
+                    conflicting = self.spent.get((input.prev_txid, input.vout))
+                    if conflicting is not None:
+                        self.remove(conflicting)
+
+    # Block template: a snapshot of pool transactions in arrival order within the limits.
+    # A transaction spending outputs of pool transactions only goes in after all of them
+    def select(self, max_bytes=MAX_BLOCK_BYTES, max_count=MAX_BLOCK_TXS):
+        selected = []
+        selected_txids = set()
+        total_size = 0
+        with self.lock:
+            for txid, entry in self.entries.items():
+                if len(selected) >= max_count:
+                    break
+                if total_size + entry.size > max_bytes:
+                    continue
+                parents = {input.prev_txid for input in entry.tx.inputs if input.prev_txid in self.entries}
+                if not parents <= selected_txids:
+                    continue
+                selected.append(entry.tx)
+                selected_txids.add(txid)
+                total_size += entry.size
+        return selected
+
+    # drop the oldest transactions until the pool fits
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_bytes and self.entries:
+                self.remove(next(iter(self.entries)))
+
+    def expire(self, now=None):
+        cutoff = (now or time.time()) - self.expiry
+        with self.lock:
+            while self.entries:
+                txid, entry = next(iter(self.entries.items()))
+                if entry.time_added >= cutoff:
+                    break
+                self.remove(txid)
@@ -0,0 +1,98 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functions import NONCE_FORMAT
+
+"""
+    Parallel proof-of-work: the nonce space is split into one contiguous
+    range per worker process, all workers share a single stop event
+"""
+
+NONCE_SPACE = 2 ** 32
+NONCE_BATCH = 10000 # nonces tried between checks of the stop event
+POLL_INTERVAL = 0.05 # seconds between checks of the caller's stop condition
+
+_stop_event = None
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+# Runs inside a worker process: grind nonces in [start, end)
+# Only the nonce is hashed per attempt, the header prefix is hashed once
+def _search(worker_id, prefix, difficulty, start, end):
+    target = "0" * difficulty
+    midstate = hashlib.sha256(prefix)
+    pack = NONCE_FORMAT.pack
+    sha256 = hashlib.sha256
+    started = time.perf_counter()
+    hashes = 0
+    for batch_start in range(start, end, NONCE_BATCH):
+        if _stop_event.is_set():
+            break
+        for nonce in range(batch_start, min(batch_start + NONCE_BATCH, end)):
+            inner = midstate.copy()
+            inner.update(pack(nonce))
+            guess = sha256(inner.digest()).hexdigest()
+            if guess.startswith(target):
+                _stop_event.set() # stop the other workers
+                hashes += nonce - batch_start + 1
+                return worker_id, nonce, guess, hashes, time.perf_counter() - started
+        hashes += min(NONCE_BATCH, end - batch_start)
+    return worker_id, None, None, hashes, time.perf_counter() - started
+
+
+class ParallelMiner:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.stop_event = multiprocessing.Event()
+        self.pool = None
+        self.hashrates = {} # worker id -> hashes per second in the last round
+
+    def start(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=_init_worker,
+                                            initargs=(self.stop_event,))
+
+    def close(self):
+        self.stop_event.set()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def stop(self):
+        self.stop_event.set()
+
+    def hashrate(self):
+        return sum(self.hashrates.values())
+
+    # Search nonces after block.nonce, returns (nonce, hash) or None when stopped
+    def mine(self, block, should_stop=lambda: False):
+        self.start()
+        self.stop_event.clear()
+
+        # workers only need the constant part of the header
+        prefix = block.header_prefix()
+
+        first = block.nonce + 1
+        span = (NONCE_SPACE - first) // self.workers
+        pending = set()
+        for worker_id in range(self.workers):
+            start = first + worker_id * span
+            end = NONCE_SPACE if worker_id == self.workers - 1 else start + span
+            pending.add(self.pool.submit(_search, worker_id, prefix, block.difficulty, start, end))
+
+        result = None
+        while pending:
+            done, pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker_id, nonce, guess, hashes, elapsed = future.result()
+                self.hashrates[worker_id] = hashes / elapsed if elapsed > 0 else 0.0
+                if guess is not None and result is None:
+                    result = (nonce, guess)
+            if should_stop():
+                self.stop_event.set()
+        return result
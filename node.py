@@ -1,14 +1,36 @@
 import socket
+import struct
 import threading
 import json
-import jsonpickle
 import time
-
-from blockchain import hashlib
-
-def str_to_Message(string):
-    json_obj = json.loads(string.decode())
-    return Message(**json_obj)
+from collections import OrderedDict
+
+from codec import encode_block, decode_block, encode_transaction, decode_transaction, \
+    encode_blocks, decode_blocks, encode_headers, decode_headers, BlockHeader
+from inventory import InventorySet, RequestTracker, INV_TX, INV_BLOCK, MAX_INV_ITEMS
+from dedup import MessageFilter
+from sendqueue import SendQueue, message_priority, PRIORITY_TX
+from sync import BlockDownloader, HEADERS_PER_MESSAGE, MAX_BLOCKS_PER_MESSAGE, STALL_CHECK_INTERVAL
+from compact import CompactBlock, encode_block_transactions, decode_block_transactions, MAX_PENDING_BLOCKS
+
+# Wire format: 4-byte big-endian payload length, then the message:
+# flags, type length, type, data - codec bytes for blocks and transactions, JSON otherwise
+FRAME_HEADER = struct.Struct('>I')
+ENVELOPE = struct.Struct('>BB')
+BROADCAST_FLAG = 1
+RAW_DATA_FLAG = 2
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+RECV_SIZE = 256 * 1024
+
+def bytes_to_Message(payload):
+    flags, type_length = ENVELOPE.unpack_from(payload)
+    start = ENVELOPE.size + type_length
+    m_type = str(payload[ENVELOPE.size:start], 'utf-8')
+    if flags & RAW_DATA_FLAG:
+        data = bytes(payload[start:])
+    else:
+        data = json.loads(str(payload[start:], 'utf-8'))
+    return Message(m_type, data, bool(flags & BROADCAST_FLAG))
 
 class Message:
     def __init__(self, m_type, data, broadcast=False) -> None:
@@ -16,12 +38,66 @@ class Message:
         self.broadcast = broadcast 
         self.data = data
 
-    def to_str(self):
-        return (json.dumps(self.__dict__) + '\r\n').encode()
-    
-    def get_id(self):
-        return hashlib.sha256(self.to_str()).hexdigest()
-        
+    def to_bytes(self):
+        flags = BROADCAST_FLAG if self.broadcast else 0
+        if isinstance(self.data, bytes):
+            flags |= RAW_DATA_FLAG
+            data = self.data
+        else:
+            data = json.dumps(self.data).encode()
+        m_type = self.m_type.encode()
+        return ENVELOPE.pack(flags, len(m_type)) + m_type + data
+
+    def to_frame(self):
+        payload = self.to_bytes()
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+
+# Per-connection receive buffer, filled with large recv_into calls.
+# A returned frame is a memoryview into the buffer, valid until the next read_frame
+class FrameReader:
+    def __init__(self, sock, max_size=MAX_MESSAGE_SIZE):
+        self.sock = sock
+        self.max_size = max_size
+        self.buffer = bytearray(RECV_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first unread byte
+        self.end = 0 # end of received data
+
+    # None when the peer disconnected
+    def read_frame(self):
+        header = self.read_exact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        (length,) = FRAME_HEADER.unpack(header)
+        # checked before any buffer is allocated for the payload
+        if length > self.max_size:
+            raise ValueError(f'Message of {length} bytes exceeds limit of {self.max_size}')
+        return self.read_exact(length)
+
+    def read_exact(self, size):
+        if self.end - self.start < size:
+            self.make_room(size)
+            while self.end - self.start < size:
+                received = self.sock.recv_into(self.view[self.end:])
+                if received == 0:
+                    return None
+                self.end += received
+        frame = self.view[self.start:self.start + size]
+        self.start += size
+        return frame
+
+    # move unread bytes to the front, grow the buffer only for frames larger than it
+    def make_room(self, size):
+        unread = self.end - self.start
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, RECV_SIZE))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+        elif self.start > 0:
+            self.view[:unread] = self.view[self.start:self.end]
+        self.start, self.end = 0, unread
+
 
 # WARNING: python collections are not threadsafe by default
 class Node:
@@ -33,16 +109,25 @@ class Node:
         self.peers = set() # addresses
         self.listen_ports = {} # map addresses to listening ports of peers
         self.peer_sockets = {} # mapping addresses to sockets
+        self.MAX_CONNETIONS=5
 
+        self.log = True 
+        self.processed_items = MessageFilter() # hashes of relayed transactions and blocks already handled
+        self.known_inventory = {} # peer socket -> InventorySet of items it has
+        self.inventory_requests = RequestTracker()
+        self.pending_blocks = OrderedDict() # block hash -> CompactBlock waiting for transactions
+        self.downloader = BlockDownloader()
+        self.send_queues = {} # peer socket -> SendQueue drained by its writer thread
+        self.queue_lock = threading.Lock()
+        self.start()
+        if self.log: print(f"Node started on {self.host}:{self.port}")
+
+    # Transport: blocking sockets with a thread per connection
+    def start(self):
         self.node = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.node.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.node.bind((self.host, self.port))
         self.node.listen(5)
-        self.MAX_CONNETIONS=5
-
-        self.log = True 
-        self.processed_messages = set() # list of IDs
-        if self.log: print(f"Node started on {self.host}:{self.port}")
 
         # start listening for connections
         listener_thread = threading.Thread(target=self.listen_for_incoming_connections)
@@ -54,11 +139,17 @@ class Node:
         sync_thread.daemon = True
         sync_thread.start()
 
+        watchdog_thread = threading.Thread(target=self.download_watchdog)
+        watchdog_thread.daemon = True
+        watchdog_thread.start()
+
     
     def close(self):
         self.active = False
         # close sockets
         self.node.close()
+        for queue in list(self.send_queues.values()):
+            queue.close()
         for peer_socket in self.peer_sockets.values():
             peer_socket.close()
         if self.log: print('node closed')
@@ -90,29 +181,26 @@ class Node:
         self.send_to_peer(client, Message('GET_LATEST_BLOCK', None)) # ask after connecting
         self.get_peer_list(client)
     
+        reader = FrameReader(client)
         while self.active:
-            data = b''
             try:
-                data += receive_complete_message(client)
+                frame = reader.read_frame()
 
                 # client disconnected?
-                if not data: 
+                if frame is None: 
                     break
-                # avoid mixing of packets
-                if not data.endswith(b'\r\n'):
-                    continue
-
-                messages = data.split(b'\r\n')
-                for m_bytes in messages:
-                    if m_bytes == b'':
-                        continue
-                    message = str_to_Message(m_bytes)
-                    self.handle_message(client, message)
+                message = bytes_to_Message(frame)
+                self.handle_message(client, message)
             except Exception as e:
                 if self.log: print(f'Node connection error: {e}')
                 break
         
         client.close()
+        queue = self.send_queues.pop(client, None)
+        if queue:
+            queue.close()
+        self.known_inventory.pop(client, None)
+        self.downloader.drop_peer(client)
         if address in self.peers:
             self.peers.remove(address)
             del self.peer_sockets[address]
@@ -126,13 +214,14 @@ class Node:
                 self.broadcast(Message('GET_PEERS', None))
             time.sleep(interval)
 
+    def download_watchdog(self, interval=STALL_CHECK_INTERVAL):
+        while self.active:
+            time.sleep(interval)
+            self.reassign_stalled()
+
     def handle_message(self, client, message: Message):
         if self.log: print(f'Received: {message.m_type}, from {client.getpeername()}', flush=True)
 
-        if message.data and message.broadcast and message.get_id() in self.processed_messages:
-            if self.log: print('-> already processed message')
-            return
-
         match message.m_type:
             case "GET_PEERS" :
                 m = Message("PEERS_LIST", list(self.listen_ports.values()))
@@ -140,57 +229,117 @@ class Node:
             case "PEERS_LIST" :
                 self.handle_peer_list(message.data)
 
+            case "INV" :
+                self.handle_inventory(client, message.data)
+            case "GETDATA" :
+                self.handle_get_data(client, message.data)
+
             case "NEW_TRANSACTION" : 
-                new_transaction = jsonpickle.decode(message.data)
+                new_transaction = decode_transaction(message.data)
+                item = (INV_TX, new_transaction.compute_txid())
+                self.peer_inventory(client).add(item)
+                self.inventory_requests.received(item)
+                if self.seen(item):
+                    return
                 if self.blockchain.receive_transaction(new_transaction):
-                    self.broadcast(message)
+                    self.processed(item)
+                    self.announce(item)
             case "NEW_BLOCK" :
-                new_block = jsonpickle.decode(message.data)
+                new_block = decode_block(message.data)
+                item = (INV_BLOCK, new_block.compute_hash())
+                self.peer_inventory(client).add(item)
+                self.inventory_requests.received(item)
+                if self.seen(item):
+                    return
                 if self.blockchain.receive_block(new_block):
-                    self.broadcast(message)
+                    self.processed(item)
+                    self.relay_block(new_block)
+
+            # compact block relay, the transactions come from the mempool
+            case "CMPCTBLOCK" :
+                self.handle_compact_block(client, CompactBlock.decode(message.data))
+            case "GETBLOCKTXN" :
+                block = self.blockchain.get_block(message.data['hash'])
+                positions = message.data['positions']
+                # answered in full or not at all
+                if block and all(isinstance(p, int) and 0 <= p < len(block.transactions) for p in positions):
+                    transactions = [block.transactions[p] for p in positions]
+                    data = encode_block_transactions(message.data['hash'], transactions)
+                    self.send_to_peer(client, Message('BLOCKTXN', data))
+            case "BLOCKTXN" :
+                block_hash, transactions = decode_block_transactions(message.data)
+                compact = self.pending_blocks.pop(block_hash, None)
+                if compact:
+                    try:
+                        compact.fill_missing(compact.missing(), transactions)
+                    except ValueError:
+                        # not what we asked for, fetch the full block
+                        self.send_to_peer(client, Message('GETDATA', [[INV_BLOCK, block_hash]]))
+                        return
+                    self.receive_compact_block(client, compact)
 
             case "GET_BLOCK" :
                 idx = int(message.data)
                 if idx == -1:
                     idx += 1
-                chain = self.blockchain.chain
-                if len(chain) > idx:
-                    block = jsonpickle.encode(chain[idx])
+                block = self.blockchain.read_block_data(idx) # one read with a flat-file block store
+                if block is None:
+                    blocks = self.blockchain.block_range(idx, 1)
+                    block = encode_block(blocks[0]) if blocks else None
+                if block is not None:
                     self.send_to_peer(client, Message('BLOCK', block))
             case "BLOCK":
-                block = jsonpickle.decode(message.data) 
-                if self.blockchain.receive_block(block):
+                block = decode_block(message.data)
+                # side branch blocks are kept, keep following the peer's branch
+                if self.blockchain.receive_block(block) or self.blockchain.get_block(block.compute_hash()):
                     self.send_to_peer(client, Message('GET_BLOCK', block.index + 1))
                 else:
                     self.send_to_peer(client, Message('GET_CONSENSUS_DATA', None))
 
             case "GET_LATEST_BLOCK" :
                 block = self.blockchain.latest_block()
-                m = Message('LATEST_BLOCK', jsonpickle.encode(block))
+                m = Message('LATEST_BLOCK', encode_block(block) if block else None)
                 self.send_to_peer(client, m)
             case "LATEST_BLOCK" :
-                received_block = jsonpickle.decode(message.data)
-                if not received_block:
+                if not message.data:
                     return
+                received_block = decode_block(message.data)
 
                 local_block = self.blockchain.latest_block()
                 local_idx = local_block.index if local_block else -1
 
                 if received_block.index > local_idx:
-                    self.send_to_peer(client, Message('GET_BLOCK', local_idx))
+                    self.start_header_sync(client)
                 if (received_block.index == local_idx \
                         and received_block.compute_hash() != local_block.compute_hash()) \
                     or received_block.index < local_idx:
                     self.send_to_peer(client, Message('GET_CONSENSUS_DATA', None))
 
+            # Headers-first sync, bodies are downloaded in ranges from all peers
+            case "GET_HEADERS" :
+                count = min(int(message.data['count']), HEADERS_PER_MESSAGE)
+                blocks = self.blockchain.block_range(int(message.data['start']), count)
+                self.send_to_peer(client, Message('HEADERS', encode_headers(blocks)))
+            case "HEADERS" :
+                self.handle_headers(client, decode_headers(message.data))
+            case "GET_BLOCKS" :
+                count = min(int(message.data['count']), MAX_BLOCKS_PER_MESSAGE)
+                blocks = self.blockchain.block_range(int(message.data['start']), count)
+                # fewer blocks if they don't fit in one message, the peer asks again for the rest
+                data = encode_blocks(blocks, MAX_MESSAGE_SIZE - ENVELOPE.size - len('BLOCKS'))
+                self.send_to_peer(client, Message('BLOCKS', data))
+            case "BLOCKS" :
+                self.connect_downloaded(self.downloader.receive(client, decode_blocks(message.data)))
+                self.schedule_downloads()
+
             # Fork handling with cumulative difficulty of chain 
             case "GET_CONSENSUS_DATA" :
-                chain_hashes = [{'index': block.index, 'hash': block.compute_hash()} for block in self.blockchain.chain]
-                data = {'chain_hashes': chain_hashes, 'cum_diff': self.blockchain.calculate_cumulative_difficulty()}
-                self.send_to_peer(client, Message('CONSENSUS_DATA', json.dumps(data)))
+                data = {'locator': self.blockchain.block_locator(),
+                        'cum_diff': self.blockchain.calculate_cumulative_difficulty()}
+                self.send_to_peer(client, Message('CONSENSUS_DATA', data))
             case "CONSENSUS_DATA" :
-                data = json.loads(message.data)
-                self.handle_consensus(client, data['chain_hashes'], data['cum_diff'])
+                data = message.data
+                self.handle_consensus(client, data['locator'], data['cum_diff'])
 
             case "PORT":
                 address = client.getpeername()
@@ -199,27 +348,147 @@ class Node:
                 if self.log: print('Unknown message type')
 
 
-        # if message.broadcast and not message.get_id() in self.processed_messages:
-        #    self.broadcast(message)
+    def peer_inventory(self, peer):
+        known = self.known_inventory.get(peer)
+        if known is None:
+            known = self.known_inventory[peer] = InventorySet()
+        return known
+
+    # Accepted transactions and blocks are not requested or handled again until the filter forgets them.
+    # Rejected ones are not recorded, they may be valid later (e.g. a missing parent arrives).
+    # Items are keyed by their hash, already a SHA-256 digest
+    def processed(self, item):
+        self.processed_items.add(bytes.fromhex(item[1]))
+
+    def seen(self, item) -> bool:
+        if bytes.fromhex(item[1]) in self.processed_items:
+            if self.log: print('-> already processed')
+            return True
+        return False
+
+    def has_inventory(self, item):
+        kind, item_hash = item
+        if kind == INV_TX:
+            return item_hash in self.blockchain.unconfirmed_transactions
+        return self.blockchain.get_block(item_hash) is not None
+
+    # request the announced items we don't have and nobody else is sending us
+    def handle_inventory(self, client, items):
+        known = self.peer_inventory(client)
+        wanted = []
+        for kind, item_hash in items[:MAX_INV_ITEMS]:
+            item = (kind, item_hash)
+            known.add(item)
+            if not self.seen(item) and not self.has_inventory(item) and self.inventory_requests.request(item):
+                wanted.append([kind, item_hash])
+        if wanted:
+            self.send_to_peer(client, Message('GETDATA', wanted))
+
+    def handle_get_data(self, client, items):
+        known = self.peer_inventory(client)
+        for kind, item_hash in items[:MAX_INV_ITEMS]:
+            if kind == INV_TX:
+                tx = self.blockchain.unconfirmed_transactions.get(item_hash)
+                message = Message('NEW_TRANSACTION', encode_transaction(tx)) if tx else None
+            else:
+                block = self.blockchain.get_block(item_hash)
+                message = Message('NEW_BLOCK', encode_block(block)) if block else None
+            if message:
+                known.add((kind, item_hash))
+                self.send_to_peer(client, message)
+
+    # INV (or the given message) to every peer not yet known to have the item
+    def announce(self, item, message=None):
+        message = message or Message('INV', [list(item)])
+        for peer in list(self.peer_sockets.values()):
+            known = self.peer_inventory(peer)
+            if item not in known:
+                known.add(item)
+                self.send_to_peer(peer, message)
+
+    # blocks are pushed as compact blocks, peers usually have the transactions already
+    def relay_block(self, block):
+        message = Message('CMPCTBLOCK', CompactBlock.from_block(block).encode())
+        self.announce((INV_BLOCK, block.compute_hash()), message)
+
+    def handle_compact_block(self, client, compact):
+        item = (INV_BLOCK, compact.block_hash)
+        self.peer_inventory(client).add(item)
+        if self.seen(item) or self.has_inventory(item) or compact.block_hash in self.pending_blocks:
+            return
+        missing = compact.fill_from(self.blockchain.unconfirmed_transactions)
+        if not missing:
+            self.receive_compact_block(client, compact)
+            return
+        self.pending_blocks[compact.block_hash] = compact
+        if len(self.pending_blocks) > MAX_PENDING_BLOCKS:
+            self.pending_blocks.popitem(last=False)
+        self.send_to_peer(client, Message('GETBLOCKTXN', {'hash': compact.block_hash, 'positions': missing}))
+
+    def receive_compact_block(self, client, compact):
+        block = compact.to_block()
+        if block is None:
+            # short ID collision, fall back to the full block
+            self.send_to_peer(client, Message('GETDATA', [[INV_BLOCK, compact.block_hash]]))
+            return
+        item = (INV_BLOCK, compact.block_hash)
+        self.inventory_requests.received(item)
+        if self.seen(item):
+            return
+        if self.blockchain.receive_block(block):
+            self.processed(item)
+            self.relay_block(block)
 
-    def handle_consensus(self, client, chain_hashes, other_cum_diff):
+    def start_header_sync(self, client):
+        if self.downloader.syncing():
+            return
+        local_block = self.blockchain.latest_block()
+        self.downloader.request_headers(client)
+        start = local_block.index + 1 if local_block else 0
+        self.send_to_peer(client, Message('GET_HEADERS', {'start': start, 'count': HEADERS_PER_MESSAGE}))
+
+    def handle_headers(self, client, headers):
+        local_block = self.blockchain.latest_block()
+        tip = BlockHeader.from_block(local_block) if local_block else None
+        if not self.downloader.add_headers(client, headers, tip):
+            # does not continue our chain, resolve the fork first
+            self.send_to_peer(client, Message('GET_CONSENSUS_DATA', None))
+            return
+        if len(headers) == HEADERS_PER_MESSAGE: # there may be more
+            self.downloader.request_headers(client)
+            data = {'start': headers[-1].index + 1, 'count': HEADERS_PER_MESSAGE}
+            self.send_to_peer(client, Message('GET_HEADERS', data))
+        self.schedule_downloads()
+
+    def schedule_downloads(self):
+        for peer, start, count in self.downloader.assign(list(self.peer_sockets.values())):
+            self.send_to_peer(peer, Message('GET_BLOCKS', {'start': start, 'count': count}))
+
+    # blocks that arrived meanwhile (e.g. relayed or from the orphan pool) are already known
+    def connect_downloaded(self, blocks):
+        for block in blocks:
+            if not self.blockchain.receive_block(block) and not self.blockchain.get_block(block.compute_hash()):
+                self.downloader.reset()
+                return
+
+    def reassign_stalled(self):
+        if self.downloader.syncing():
+            self.downloader.reassign_stalled()
+            self.schedule_downloads()
+
+    def handle_consensus(self, client, locator, other_cum_diff):
         cum_diff = self.blockchain.calculate_cumulative_difficulty()
-        last_common_block_idx = self.last_common_block(chain_hashes)
+        fork_block = self.blockchain.find_fork(locator)
+        last_common_block_idx = fork_block.index if fork_block else -1
         if cum_diff > other_cum_diff:
             # we win fork -> they need to sync
-            block = jsonpickle.encode(self.blockchain.chain[last_common_block_idx + 1])
-            self.send_to_peer(client, Message('BLOCK', block))
+            blocks = self.blockchain.block_range(last_common_block_idx + 1, 1)
+            if blocks:
+                self.send_to_peer(client, Message('BLOCK', encode_block(blocks[0])))
         elif cum_diff < other_cum_diff:
             # peer wins fork -> we need to sync
             self.send_to_peer(client, Message('GET_BLOCK', last_common_block_idx + 1))
 
-    def last_common_block(self, chain_hashes):
-        min_len = min(len(chain_hashes), len(self.blockchain.chain))
-        for i in range(min_len - 1):
-            if chain_hashes[i]['hash'] != self.blockchain.chain[i].compute_hash():
-                return i - 1
-        return min_len 
-
     
 
     def connect_to_peer(self, peer_host, peer_port):
@@ -240,28 +509,70 @@ class Node:
 
         return peer_socket
 
+    # Queued for the peer's writer thread, never blocks the caller
     def send_to_peer(self, peer, message):
         if self.log: print(f'Sending: {message.m_type}, to {peer.getpeername()}')
+        priority = message_priority(message.m_type)
+        queue = self.send_queue(peer)
+        if not queue.put(message.to_frame(), priority) and not queue.closed:
+            self.queue_overflow(peer, priority)
+
+    def send_queue(self, peer):
+        with self.queue_lock:
+            queue = self.send_queues.get(peer)
+            if queue is None:
+                queue = self.send_queues[peer] = SendQueue()
+                threading.Thread(target=self.write_to_peer, args=(peer, queue), daemon=True).start()
+            return queue
+
+    def write_to_peer(self, peer, queue):
+        while (frame := queue.get()) is not None:
+            try:
+                peer.sendall(frame)
+            except Exception as e:
+                if self.log: print(f"Error sending message to peer: {e}")
+                self.disconnect_peer(peer)
+                break
+
+    # Transactions are dropped, for anything else the peer is too far behind
+    def queue_overflow(self, peer, priority):
+        if priority == PRIORITY_TX:
+            if self.log: print(f'Send queue full, dropped transaction message to {peer.getpeername()}')
+        else:
+            if self.log: print(f'Send queue full, disconnecting {peer.getpeername()}')
+            self.disconnect_peer(peer)
+
+    # the reader thread notices and cleans up
+    def disconnect_peer(self, peer):
+        queue = self.send_queues.get(peer)
+        if queue:
+            queue.close()
         try:
-            peer.sendall(message.to_str()) 
-        except Exception as e:
-            if self.log: print(f"Error sending message to peer: {e}")
+            peer.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # frames and bytes waiting per peer
+    def queue_depths(self):
+        return {address: self.send_queues[peer].depth()
+                for address, peer in list(self.peer_sockets.items()) if peer in self.send_queues}
 
     def broadcast(self, message: Message):
         message.broadcast = True
-        self.processed_messages.add(message.get_id())
         for peer in self.peers:
             peer_socket = self.peer_sockets.get(peer)
             if peer_socket:
                 self.send_to_peer(peer_socket, message)
 
+    # our own items are never requested back
     def new_block(self, block):
-        json_str = jsonpickle.encode(block)
-        self.broadcast(Message('NEW_BLOCK', json_str))
+        self.processed((INV_BLOCK, block.compute_hash()))
+        self.relay_block(block)
 
     def new_transaction(self, transaction):
-        json_str = jsonpickle.encode(transaction)
-        self.broadcast(Message('NEW_TRANSACTION', json_str))
+        item = (INV_TX, transaction.compute_txid())
+        self.processed(item)
+        self.announce(item)
 
     def get_peer_list(self, client):
         self.send_to_peer(client, Message("GET_PEERS", None))
@@ -279,18 +590,3 @@ class Node:
                     self.connect_to_peer(*peer_tuple)
                 except ConnectionError:
                     if self.log: print(f'Failed to connect to: {peer_tuple}')
-
-# Account for large messages with fragmentation
-def receive_complete_message(client_socket):
-    data = b''
-    while True:
-        part = client_socket.recv(1024)
-        if not part:
-            return None
-
-        data += part
-        # Either 0 or end of data
-        if len(part) < 1024:
-            break
-    return data
-
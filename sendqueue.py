@@ -0,0 +1,89 @@
+import threading
+from collections import deque
+
+"""
+    Bounded outbound queue of one peer, drained by that peer's writer so a
+    slow peer never blocks the thread that sends to it.
+    Frames are queued by priority: blocks first, then control messages, then
+    transactions. A full queue rejects the frame, the node drops rejected
+    transactions and disconnects the peer for anything else. An empty queue
+    takes any frame, so a single large reply never counts as an overflow.
+    A closed queue rejects everything, its peer is being disconnected.
+"""
+
+PRIORITY_BLOCK = 0
+PRIORITY_CONTROL = 1
+PRIORITY_TX = 2
+MAX_QUEUE_BYTES = 64 * 1024 * 1024 # two messages at the node's size limit
+
+BLOCK_MESSAGES = {'NEW_BLOCK', 'CMPCTBLOCK', 'BLOCKTXN', 'BLOCK', 'BLOCKS', 'HEADERS', 'LATEST_BLOCK'}
+TX_MESSAGES = {'NEW_TRANSACTION', 'INV'}
+
+def message_priority(m_type):
+    if m_type in BLOCK_MESSAGES:
+        return PRIORITY_BLOCK
+    if m_type in TX_MESSAGES:
+        return PRIORITY_TX
+    return PRIORITY_CONTROL
+
+
+class SendQueue:
+    def __init__(self, max_bytes=MAX_QUEUE_BYTES):
+        self.max_bytes = max_bytes
+        self.queues = [deque() for _ in range(PRIORITY_TX + 1)]
+        self.bytes = 0
+        self.sending = False # a frame was taken and is being written
+        self.closed = False
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    # False if the frame does not fit or the queue is closed
+    def put(self, frame, priority=PRIORITY_CONTROL) -> bool:
+        with self.condition:
+            if self.closed:
+                return False
+            if self.bytes and self.bytes + len(frame) > self.max_bytes:
+                self.dropped += 1
+                return False
+            self.queues[priority].append(frame)
+            self.bytes += len(frame)
+            self.condition.notify()
+            return True
+
+    # Next frame by priority or None, does not wait
+    def pop(self):
+        with self.condition:
+            for queue in self.queues:
+                if queue:
+                    frame = queue.popleft()
+                    self.bytes -= len(frame)
+                    self.sending = True
+                    return frame
+            self.sending = False
+            self.condition.notify_all()
+            return None
+
+    # Blocks until a frame is queued, None once the queue is closed
+    def get(self):
+        with self.condition:
+            while True:
+                frame = self.pop()
+                if frame is not None or self.closed:
+                    return frame
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # wait until everything queued so far has been written
+    def join(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.closed or (not self.sending and len(self) == 0), timeout)
+
+    def depth(self):
+        return {'frames': len(self), 'bytes': self.bytes, 'dropped': self.dropped}
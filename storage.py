@@ -1,10 +1,11 @@
 # storage.py
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, ReplaceOne, UpdateMany
 import redis
+import threading
 import time
+from collections import deque
 from itertools import islice
 from transaction import Input, Output, Transaction
-from blockchain import *
 from bson import ObjectId
 import json
 
@@ -12,6 +13,42 @@ MONGODB_URI = "mongodb://localhost:27017/"
 MONGODB_DB_NAME = "blockchain_db"
 REDIS_HOST = "localhost"
 REDIS_PORT = 6379
+BLOCK_BATCH = 64 # pending block writes that trigger a flush
+FLUSH_INTERVAL = 1.0 # seconds between flushes of the block writer
+
+# One document per block, the hash is the _id. Orphaned blocks were disconnected by a reorg
+def block_to_document(block, orphaned=False):
+    return {
+        "_id": block.compute_hash(),
+        "index": block.index,
+        "previousHash": block.previous_hash,
+        "merkleRoot": block.merkle_root,
+        "timestamp": int(block.timestamp),
+        "difficulty": block.difficulty,
+        "nonce": block.nonce,
+        "orphaned": orphaned,
+        "transactions": [{
+            "index": tx.index,
+            "inputs": [{"prev_txid": i.prev_txid, "vout": i.vout, "signature": i.signature,
+                        "public_key": i.public_key} for i in tx.inputs],
+            "outputs": [{"address": o.address, "amount": o.amount} for o in tx.outputs]
+        } for tx in block.transactions],
+    }
+
+def document_to_block(document):
+    from blockchain import Block # blockchain imports this module
+    transactions = []
+    for tx_data in document["transactions"]:
+        inputs = []
+        for input_data in tx_data["inputs"]:
+            input = Input(input_data["prev_txid"], input_data["vout"])
+            input.signature = input_data["signature"]
+            input.public_key = input_data["public_key"]
+            inputs.append(input)
+        outputs = [Output(o["address"], o["amount"]) for o in tx_data["outputs"]]
+        transactions.append(Transaction(inputs, outputs, tx_data["index"]))
+    return Block(document["index"], document["previousHash"], transactions,
+                 document["timestamp"], document["nonce"], document["difficulty"])
 
 class StorageManager:
     def __init__(self):
@@ -21,6 +58,15 @@ class StorageManager:
         
         self.transactions_collection = self.mongo_db.transactions
         self.blockchain_collection = self.mongo_db.blockchain_data
+        self.blocks_collection = self.mongo_db.blocks
+
+        # Block writes are queued by the blockchain and written in bulk by a background thread
+        self.pending_writes = []
+        self.write_lock = threading.Lock()
+        self.flush_lock = threading.Lock() # one bulk write at a time keeps them in order
+        self.flush_event = threading.Event()
+        self.writer_thread = None
+        self.indexes_created = False
         
         # Initialize Redis client
         self.redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
@@ -89,79 +135,75 @@ class StorageManager:
         self.transactions_collection.insert_one(transaction_data)
         print("Transaction stored successfully.")
 
+    # Connected blocks are upserted, a block connected again after a reorg is no longer orphaned.
+    # Any other block stored at the same height (e.g. from an earlier run) is orphaned
+    def blocks_connected(self, blocks):
+        operations = []
+        for block in blocks:
+            block_hash = block.compute_hash()
+            operations.append(UpdateMany({"index": block.index, "orphaned": False, "_id": {"$ne": block_hash}},
+                                         {"$set": {"orphaned": True}}))
+            operations.append(ReplaceOne({"_id": block_hash}, block_to_document(block), upsert=True))
+        self.queue_writes(operations)
+
+    def blocks_disconnected(self, blocks):
+        hashes = [block.compute_hash() for block in blocks]
+        self.queue_writes([UpdateMany({"_id": {"$in": hashes}}, {"$set": {"orphaned": True}})])
+
+    def queue_writes(self, operations):
+        with self.write_lock:
+            self.pending_writes.extend(operations)
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self.write_blocks, daemon=True)
+                self.writer_thread.start()
+            if len(self.pending_writes) >= BLOCK_BATCH:
+                self.flush_event.set()
+
+    def write_blocks(self):
+        while self.writer_thread is not None:
+            self.flush_event.wait(FLUSH_INTERVAL)
+            self.flush_event.clear()
+            self.flush_blocks()
+
+    # One ordered bulk write of everything pending, kept for the next flush if it fails
+    def flush_blocks(self):
+        with self.flush_lock:
+            with self.write_lock:
+                operations, self.pending_writes = self.pending_writes, []
+            if not operations:
+                return
+            try:
+                if not self.indexes_created:
+                    self.blocks_collection.create_index([("orphaned", ASCENDING), ("index", ASCENDING)])
+                    self.indexes_created = True
+                self.blocks_collection.bulk_write(operations, ordered=True)
+            except Exception as e:
+                print(f"Error storing blocks: {e}")
+                with self.write_lock:
+                    self.pending_writes[:0] = operations
+
+    # Blocks are stored as they are connected, this writes what is still pending and
+    # stores the whole chain only if the collection is missing blocks (e.g. first run)
     def store_blockchain_data(self, blockchain):
-        blockchain_data = {"chain": []}
-
-        # Store the genesis block
-        genesis_block = blockchain.chain[0]
-        genesis_block_data = {
-            "index": genesis_block.index,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(genesis_block.timestamp)),
-            "data": "Genesis block of simple chain",
-            "previousHash": genesis_block.previous_hash,
-            "merkleRoot": genesis_block.merkle_root,
-            "hash": genesis_block.compute_hash(),
-            "difficulty": genesis_block.difficulty,
-            "nonce": genesis_block.nonce,
-        }
-        blockchain_data["chain"].append(genesis_block_data)
-
-        # Store subsequent blocks
-        for block in islice(blockchain.chain, 1, None):
-            data = [{
-                'inputs': [vars(i) for i in tx.inputs],
-                'outputs': [vars(o) for o in tx.outputs]
-            } for tx in block.transactions]
-            block_data = {
-                "index": block.index,
-                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(block.timestamp)),
-                "data": data,
-                "previousHash": block.previous_hash,
-                "merkleRoot": block.merkle_root,
-                "hash": block.compute_hash(),
-                "difficulty": block.difficulty,
-                "nonce": block.nonce,
-            }
-            blockchain_data["chain"].append(block_data)
-
-        #debugging output
-        #print("Blockchain data to be stored:")
-        #print(json.dumps(blockchain_data, indent=2))
-
-        # Store or update in MongoDB
-        self.blockchain_collection.update_one({}, {"$set": blockchain_data}, upsert=True)
+        self.flush_blocks()
+        if self.blocks_collection.count_documents({"orphaned": False}) < len(blockchain.chain):
+            self.blocks_connected(list(blockchain.chain))
+            self.flush_blocks()
         print("Blockchain data stored successfully.")
 
+    # blocks are stored as documents, the node encodes them itself
+    def read_block_data(self, height):
+        return None
+
     def load_blockchain_data(self):
-        result = self.mongo_db.blockchain_data.find_one({})
-        chain = []
-        if result:
-            chain_data = result["chain"]
-
-            for block_data in chain_data:
-                index = block_data["index"]
-                timestamp = time.mktime(time.strptime(block_data["timestamp"], "%Y-%m-%d %H:%M:%S"))
-                previous_hash = block_data["previousHash"]
-                nonce = block_data["nonce"]
-                difficulty = block_data["difficulty"]
-
-                # Reconstruct transactions from the stored data
-                transactions_data = block_data["data"]
-                transactions = []
-                for transaction_data in transactions_data:
-                    inputs = transaction_data["inputs"]
-                    outputs = transaction_data["outputs"]
-                    transaction = Transaction(inputs, outputs)
-                    transactions.append(transaction)
-
-                # Create the block and add it to the blockchain
-                block = Block(index, previous_hash, transactions, timestamp, nonce, difficulty)
-                chain.append(block)
-            return chain
-        else:
-            return None  # Or whatever makes sense for your application
+        cursor = self.blocks_collection.find({"orphaned": False}).sort("index", ASCENDING)
+        chain = deque(document_to_block(document) for document in cursor)
+        return chain if chain else None
            
     def close_connection(self):
+        self.writer_thread = None
+        self.flush_event.set()
+        self.flush_blocks()
         self.mongo_client.close()
 
     def store_latest_states_in_memory(self, key, value):
@@ -171,15 +213,11 @@ class StorageManager:
         return self.redis_client.get(key)
     
     def print_blockchain_data(self, limit=None):
-        cursor = self.blockchain_collection.find({}).limit(limit)
+        cursor = self.blocks_collection.find({"orphaned": False}).sort("index", ASCENDING).limit(limit or 0)
+        print("Blockchain data from database:")
         for document in cursor:
-            print("Blockchain data from database:")
-            # Remove the _id field
-            if '_id' in document:
-                del document['_id']
-            # Convert the document to a JSON string
-            json_document = json.dumps(document, indent=2)
-            print(json_document)
+            document["hash"] = document.pop("_id")
+            print(json.dumps(document, indent=2))
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
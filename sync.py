@@ -0,0 +1,184 @@
+import heapq
+import threading
+import time
+
+"""
+    Headers-first block download. The header chain is fetched from one peer
+    and checked (links and proof of work), then block bodies are requested in
+    ranges from all connected peers. At most REQUESTS_PER_PEER ranges are in
+    flight per peer and only blocks within DOWNLOAD_WINDOW of the next block to
+    connect are requested, so out-of-order arrivals stay bounded.
+    Ranges of stalled or misbehaving peers go back to the queue for others.
+"""
+
+HEADERS_PER_MESSAGE = 2000
+BLOCKS_PER_REQUEST = 16
+MAX_BLOCKS_PER_MESSAGE = 128 # served per GET_BLOCKS
+REQUESTS_PER_PEER = 2
+DOWNLOAD_WINDOW = 1024 # blocks ahead of the next block to connect
+STALL_TIMEOUT = 15 # seconds
+STALL_CHECK_INTERVAL = 2
+
+class RangeRequest:
+    def __init__(self, start, count, peer, time_sent):
+        self.start = start
+        self.count = count
+        self.peer = peer
+        self.time_sent = time_sent
+
+
+class BlockDownloader:
+    def __init__(self, window=DOWNLOAD_WINDOW, range_size=BLOCKS_PER_REQUEST,
+                 requests_per_peer=REQUESTS_PER_PEER, stall_timeout=STALL_TIMEOUT):
+        self.window = window
+        self.range_size = range_size
+        self.requests_per_peer = requests_per_peer
+        self.stall_timeout = stall_timeout
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.header_hashes = {} # index -> expected block hash
+            self.last_header = None
+            self.headers_peer = None # peer asked for headers and when
+            self.headers_requested = 0
+            self.next_index = None # next block to connect
+            self.next_request = None # first index never requested
+            self.queue = [] # heap of (start, count) to request again
+            self.in_flight = {} # start -> RangeRequest
+            self.received = {} # index -> block, not connected yet
+            self.excluded = set() # peers that failed during this sync
+
+    def syncing(self):
+        return self.headers_peer is not None or self.next_index is not None
+
+    def request_headers(self, peer, now=None):
+        with self.lock:
+            self.headers_peer = peer
+            self.headers_requested = now or time.time()
+
+    # Headers must continue our tip (or the headers received so far) with valid proofs of work.
+    # tip is None for an empty chain
+    def add_headers(self, peer, headers, tip) -> bool:
+        with self.lock:
+            if peer is not self.headers_peer:
+                return False
+            self.headers_peer = None
+            previous = self.last_header or tip
+            for header in headers:
+                if previous is None:
+                    valid = header.index == 0
+                else:
+                    valid = header.index == previous.index + 1 and header.previous_hash == previous.hash
+                if not valid or not header.hash.startswith('0' * header.difficulty):
+                    return False
+                self.header_hashes[header.index] = header.hash
+                previous = header
+            if headers:
+                if self.next_index is None:
+                    self.next_index = self.next_request = headers[0].index
+                self.last_header = previous
+            return True
+
+    # (peer, start, count) requests to send, round-robin over the peers
+    def assign(self, peers, now=None):
+        now = now or time.time()
+        with self.lock:
+            if self.next_index is None:
+                return []
+            peers = [peer for peer in peers if peer not in self.excluded] or peers
+            self.excluded.intersection_update(peers)
+            requests = []
+            assigned = True
+            while assigned:
+                assigned = False
+                for peer in peers:
+                    if self.peer_requests(peer) >= self.requests_per_peer:
+                        continue
+                    next_range = self.next_range()
+                    if next_range is None:
+                        return requests
+                    start, count = next_range
+                    self.in_flight[start] = RangeRequest(start, count, peer, now)
+                    requests.append((peer, start, count))
+                    assigned = True
+            return requests
+
+    def peer_requests(self, peer):
+        return sum(1 for request in self.in_flight.values() if request.peer is peer)
+
+    def next_range(self):
+        if self.queue and self.queue[0][0] < self.next_index + self.window:
+            return heapq.heappop(self.queue)
+        end = min(self.last_header.index + 1, self.next_index + self.window)
+        if self.next_request >= end:
+            return None
+        start = self.next_request
+        count = min(self.range_size, end - start)
+        self.next_request += count
+        return (start, count)
+
+    # Store the blocks of a range, returns the blocks that can be connected now in order.
+    # Missing blocks are requested again, a reply cut short by the message size limit is fine.
+    # Blocks that don't match the header chain or an empty reply exclude the peer
+    def receive(self, peer, blocks):
+        with self.lock:
+            if not blocks:
+                request = next((r for r in self.in_flight.values() if r.peer is peer), None)
+            else:
+                request = self.in_flight.get(blocks[0].index)
+            if request is None or request.peer is not peer:
+                return []
+            del self.in_flight[request.start]
+
+            blocks = blocks[:request.count]
+            stored = 0
+            for offset, block in enumerate(blocks):
+                index = request.start + offset
+                if block.index != index or block.compute_hash() != self.header_hashes.get(index):
+                    break
+                if index >= self.next_index:
+                    self.received[index] = block
+                stored += 1
+            if stored < len(blocks) or stored == 0:
+                self.excluded.add(peer)
+            if stored < request.count:
+                heapq.heappush(self.queue, (request.start + stored, request.count - stored))
+            return self.ready()
+
+    def ready(self):
+        blocks = []
+        while self.next_index in self.received:
+            blocks.append(self.received.pop(self.next_index))
+            self.next_index += 1
+        if self.next_index > self.last_header.index and not self.in_flight:
+            # done, a request for more headers stays open until answered or timed out
+            headers_peer, headers_requested = self.headers_peer, self.headers_requested
+            self.reset()
+            self.headers_peer, self.headers_requested = headers_peer, headers_requested
+        return blocks
+
+    # Requests older than the timeout go back to the queue, their peers are skipped
+    def reassign_stalled(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            if self.headers_peer is not None and now - self.headers_requested > self.stall_timeout:
+                self.headers_peer = None
+            for start, request in list(self.in_flight.items()):
+                if now - request.time_sent > self.stall_timeout:
+                    self.release(request)
+                    self.excluded.add(request.peer)
+
+    def drop_peer(self, peer):
+        with self.lock:
+            if self.headers_peer is peer:
+                self.headers_peer = None
+            for request in list(self.in_flight.values()):
+                if request.peer is peer:
+                    self.release(request)
+            self.excluded.discard(peer)
+
+    def release(self, request):
+        del self.in_flight[request.start]
+        heapq.heappush(self.queue, (request.start, request.count))
@@ -1,12 +1,63 @@
 import unittest
 import time
+import os
+import socket
+import threading
+import tempfile
+import jsonpickle
 from blockchain import Blockchain, Block
-from node import Node
+from node import Node, Message, FrameReader, bytes_to_Message
+from async_node import AsyncNode
+from miner import ParallelMiner
+from verify import BatchVerifier, SignatureCache
+from mempool import Mempool, transaction_size
+from utxo import MemoryUTXOStore, SQLiteUTXOStore, CoinsView
+from codec import encode_block, decode_block, encode_transaction, decode_transaction
+from compact import CompactBlock, encode_block_transactions
+from dedup import MessageFilter
+from storage import block_to_document, document_to_block
+from blockstore import FlatFileBlockStore
+from sendqueue import SendQueue, PRIORITY_BLOCK, PRIORITY_TX
+from sync import BlockDownloader
+from codec import BlockHeader, encode_blocks, decode_blocks
 from functions import *
 from transaction import *
 
 HOST='127.0.0.1'
 
+# Block store that keeps nothing, tests don't write to MongoDB
+class NullStorage:
+    def blocks_connected(self, blocks):
+        pass
+
+    def blocks_disconnected(self, blocks):
+        pass
+
+    def read_block_data(self, height):
+        return None
+
+    def load_blockchain_data(self):
+        return None
+
+    def store_transaction(self, transaction):
+        pass
+
+    def load_all_transactions(self):
+        return []
+
+    def store_blockchain_data(self, blockchain):
+        pass
+
+    def close_connection(self):
+        pass
+
+# Linked empty blocks with difficulty 0, every hash is a valid proof
+def make_chain(length):
+    chain = [Block(0, "0" * 64, [], 1, 0, 0)]
+    for index in range(1, length):
+        chain.append(Block(index, chain[-1].compute_hash(), [], 1 + index, 0, 0))
+    return chain
+
 class TestBlockchain(unittest.TestCase):
 
     def test_transaction_creation_and_verification(self):
@@ -112,3 +163,850 @@ class TestBlockchain(unittest.TestCase):
         blockchain.mine("miner_address")
         self.assertEqual(len(blockchain.unconfirmed_transactions), 0)
         blockchain.quit()
+
+
+    def test_parallel_mining(self):
+        miner = ParallelMiner(workers=2)
+        block = Block(1, "0" * 64, [], int(time.time()), 0, 3)
+        try:
+            nonce, proof = miner.mine(block)
+        finally:
+            miner.close()
+
+        block.nonce = nonce
+        self.assertEqual(block.compute_hash(), proof)
+        self.assertTrue(proof.startswith("000"))
+        self.assertEqual(set(miner.hashrates), {0, 1})
+
+    def test_parallel_mining_stop(self):
+        miner = ParallelMiner(workers=2)
+        block = Block(1, "0" * 64, [], int(time.time()), 0, 64) # unreachable target
+        try:
+            self.assertIsNone(miner.mine(block, lambda: True))
+        finally:
+            miner.close()
+
+    def test_block_hash_memoization(self):
+        block = Block(1, "0" * 64, [], int(time.time()), 0, 4)
+        first = block.compute_hash()
+        self.assertIs(block.compute_hash(), first)
+
+        block.nonce += 1
+        self.assertNotEqual(block.compute_hash(), first)
+        block.timestamp += 1
+        copied = jsonpickle.decode(jsonpickle.encode(block))
+        self.assertEqual(copied.compute_hash(), block.compute_hash())
+
+    def test_txid_cache_invalidation(self):
+        transaction = Transaction([Input("previous_txid", 0)], [Output("address", 10)])
+        txid = transaction.compute_txid()
+        self.assertEqual(txid, hashlib.sha256(transaction.serialize()).hexdigest())
+
+        transaction.add_output(Output("other_address", 1.5))
+        self.assertNotEqual(transaction.compute_txid(), txid)
+
+        copied = jsonpickle.decode(jsonpickle.encode(transaction))
+        self.assertEqual(copied.compute_txid(), transaction.compute_txid())
+
+    def test_batch_signature_verification(self):
+        checks = []
+        for _ in range(6):
+            private_key, address = generate_address()
+            transaction = Transaction([Input("previous_txid", 0)], [Output(address, 1)])
+            transaction.sign(private_key)
+            checks.extend(transaction.signature_checks())
+
+        verifier = BatchVerifier(workers=2, chunk_size=2, min_parallel=1)
+        try:
+            self.assertTrue(verifier.verify(checks))
+            tx_id, index, signature, public_key = checks[3]
+            checks[3] = ("tampered_txid", index, signature, public_key)
+            self.assertFalse(verifier.verify(checks))
+        finally:
+            verifier.close()
+
+    def test_signature_cache(self):
+        private_key, address = generate_address()
+        transaction = Transaction([Input("previous_txid", 0)], [Output(address, 1)])
+        transaction.sign(private_key)
+        checks = transaction.signature_checks()
+
+        verifier = BatchVerifier(workers=1, cache=SignatureCache(max_size=10))
+        self.assertTrue(verifier.verify(checks)) # mempool acceptance
+        self.assertTrue(verifier.verify(checks)) # same transaction inside a block
+        self.assertEqual(verifier.cache.hits, 1)
+        self.assertEqual(verifier.cache.hit_rate(), 0.5)
+
+    def test_mining_reward_with_memory_utxos(self):
+        node = Node(HOST, 2228)
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        blockchain.difficulty = 3
+        try:
+            blockchain.create_genesis_block(difficulty=3)
+            _, miner = generate_address()
+            blockchain.mine(miner)
+            blockchain.mine(miner)
+
+            self.assertTrue(blockchain.is_chain_valid())
+            self.assertEqual(blockchain.get_balance(miner), 2)
+            self.assertEqual(blockchain.find_inputs(miner, 2)[0], 2)
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_pool_transaction_chain(self):
+        node = Node(HOST, 2233)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        try:
+            private_key, address = generate_address()
+            coinbase = Transaction([], [Output(address, 10)], 1)
+            blockchain.utxos.apply_block(Block(1, "0" * 64, [coinbase], 1, 0, 0), "block1")
+            parent = Transaction([Input(coinbase.compute_txid(), 0)], [Output(address, 10)])
+            parent.sign(private_key)
+            child = Transaction([Input(parent.compute_txid(), 0)], [Output("bob", 10)])
+            child.sign(private_key)
+            overspend = Transaction([Input(parent.compute_txid(), 0)], [Output("bob", 11)])
+            overspend.sign(private_key)
+
+            self.assertFalse(blockchain.receive_transaction(child)) # parent unknown
+            self.assertTrue(blockchain.receive_transaction(parent))
+            self.assertFalse(blockchain.receive_transaction(overspend))
+            self.assertTrue(blockchain.receive_transaction(child))
+            self.assertEqual(blockchain.unconfirmed_transactions.select(), [parent, child])
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_failed_reorg_returns_transactions(self):
+        node = Node(HOST, 2235)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        blockchain.difficulty = 0
+        try:
+            private_key, address = generate_address()
+            coinbase = Transaction([], [Output(address, 10)], 1)
+            main = make_chain(1)
+            main.append(Block(1, main[0].compute_hash(), [coinbase], 2, 0, 0))
+            main.append(Block(2, main[1].compute_hash(), [], 3, 0, 0))
+            for block in main:
+                self.assertTrue(blockchain.receive_block(block))
+            payment = Transaction([Input(coinbase.compute_txid(), 0)], [Output("bob", 10)])
+            payment.sign(private_key)
+            self.assertTrue(blockchain.receive_transaction(payment))
+
+            # the branch confirms the payment, then fails on an unknown input
+            first = Block(2, main[1].compute_hash(), [payment], 10, 0, 0)
+            invalid = Block(3, first.compute_hash(), [Transaction([Input("ab" * 32, 0)], [Output("bob", 1)])], 11, 0, 0)
+            self.assertFalse(blockchain.receive_block(first)) # equal work, side branch
+            self.assertFalse(blockchain.receive_block(invalid))
+            self.assertEqual(list(blockchain.chain), main)
+            self.assertIn(payment.compute_txid(), blockchain.unconfirmed_transactions)
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_block_locator(self):
+        node = Node(HOST, 2229)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        try:
+            blocks = make_chain(1000)
+            blockchain.connect_blocks(blocks)
+            locator = blockchain.block_locator()
+            self.assertEqual(locator[:10], [block.compute_hash() for block in reversed(blocks[-10:])])
+            self.assertEqual(locator[-1], blocks[0].compute_hash())
+            self.assertLess(len(locator), 30)
+
+            # a peer that forked after block 500 is missing our later blocks
+            other = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+            other.connect_blocks(blocks[:501])
+            fork = Block(501, blocks[500].compute_hash(), [], 10000, 0, 0)
+            other.connect_blocks([fork])
+            self.assertIs(blockchain.find_fork(other.block_locator()), blocks[500])
+            self.assertIsNone(blockchain.find_fork([fork.compute_hash()]))
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_cached_chain_work(self):
+        node = Node(HOST, 2230)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        try:
+            blocks = make_chain(5)
+            blocks[4].difficulty = 3
+            blockchain.max_undo_depth = 2
+            blockchain.connect_blocks(blocks)
+            self.assertEqual(blockchain.calculate_cumulative_difficulty(), 4 + 2 ** 3)
+            self.assertEqual(blocks[2].chain_work, 3)
+            # undo data is kept for the last two blocks only
+            self.assertEqual(set(blockchain.utxos.undo), {blocks[3].compute_hash(), blocks[4].compute_hash()})
+
+            blockchain.disconnect_blocks(3)
+            self.assertEqual(blockchain.calculate_cumulative_difficulty(), 3)
+            blockchain.disconnect_blocks(1) # past the undo data, the set is rebuilt
+            self.assertEqual(blockchain.utxos.best_block(), blocks[0].compute_hash())
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_block_tree_branches_and_orphans(self):
+        node = Node(HOST, 2231)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        blockchain.difficulty = 0 # side blocks must have the expected difficulty
+        try:
+            main = make_chain(4)
+            for block in main:
+                self.assertTrue(blockchain.receive_block(block))
+            branch = [main[1]]
+            for index in range(2, 5): # forks after block 1 and outgrows the main chain
+                branch.append(Block(index, branch[-1].compute_hash(), [], 1000 + index, 0, 0))
+
+            self.assertFalse(blockchain.receive_block(branch[3])) # parent unknown -> orphan pool
+            self.assertFalse(blockchain.receive_block(branch[2]))
+            self.assertEqual(len(blockchain.orphans), 2)
+            self.assertTrue(blockchain.receive_block(branch[1])) # connects both orphans, then reorganizes
+            self.assertEqual(len(blockchain.orphans), 0)
+            self.assertEqual(list(blockchain.chain), main[:2] + branch[1:])
+
+            # the old branch stays in the tree, two more blocks switch back to it
+            main.append(Block(4, main[3].compute_hash(), [], 5, 0, 0))
+            main.append(Block(5, main[4].compute_hash(), [], 6, 0, 0))
+            self.assertFalse(blockchain.receive_block(main[4])) # equal work
+            self.assertTrue(blockchain.receive_block(main[5]))
+            self.assertEqual(list(blockchain.chain), main)
+            self.assertIs(blockchain.get_block(branch[3].compute_hash()), branch[3])
+
+            # an invalid block takes its descendants out of the tree
+            blockchain.remove_from_tree(branch[2])
+            self.assertIsNone(blockchain.get_block(branch[3].compute_hash()))
+            self.assertIs(blockchain.get_block(branch[1].compute_hash()), branch[1])
+            self.assertEqual(blockchain.tree_children[main[1].compute_hash()],
+                             {main[2].compute_hash(), branch[1].compute_hash()})
+            self.assertFalse(blockchain.receive_block(Block(5, "some_hash", [], 1, 0, 0))) # malformed header
+
+            # cheaper side blocks than the expected difficulty are not kept
+            blockchain.difficulty = 1
+            side = Block(2, main[1].compute_hash(), [], 77, 0, 0)
+            self.assertFalse(blockchain.receive_block(side))
+            self.assertIsNone(blockchain.get_block(side.compute_hash()))
+
+            blockchain.max_orphans = 2
+            for index in range(3):
+                blockchain.receive_block(Block(10 + index, "ab" * 32, [], 1, index, 0))
+            self.assertEqual(len(blockchain.orphans), 2)
+            self.assertEqual(len(blockchain.orphans_by_parent["ab" * 32]), 2)
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+
+class TestUTXOStore(unittest.TestCase):
+
+    def check_store(self, utxos):
+        coinbase = Transaction([], [Output("alice", 10)], 1)
+        block1 = Block(1, "0", [coinbase], int(time.time()), 0, 1)
+        utxos.apply_block(block1, block1.compute_hash())
+        self.assertEqual(utxos.balance("alice"), 10)
+
+        payment = Transaction([Input(coinbase.compute_txid(), 0)], [Output("bob", 4), Output("alice", 6)])
+        block2 = Block(2, block1.compute_hash(), [payment], int(time.time()), 0, 1)
+        utxos.apply_block(block2, block2.compute_hash())
+        self.assertEqual(utxos.balance("alice"), 6)
+        self.assertEqual(utxos.balance("bob"), 4)
+        self.assertNotIn((coinbase.compute_txid(), 0), utxos)
+        self.assertEqual([key for key, _ in utxos.unspent("bob")], [(payment.compute_txid(), 0)])
+        self.assertEqual(utxos.best_block(), block2.compute_hash())
+
+        # reorg back to block1 restores the spent coinbase output
+        self.assertTrue(utxos.disconnect_block(block2, block2.compute_hash()))
+        self.assertEqual(utxos.balance("alice"), 10)
+        self.assertEqual(utxos.balance("bob"), 0)
+        self.assertEqual(utxos[(coinbase.compute_txid(), 0)].amount, 10)
+        self.assertEqual(utxos.best_block(), block1.compute_hash())
+        self.assertFalse(utxos.disconnect_block(block2, block2.compute_hash()))
+
+    def test_coins_view(self):
+        with tempfile.TemporaryDirectory() as directory:
+            utxos = SQLiteUTXOStore(os.path.join(directory, "utxos.sqlite3"))
+            coinbase = Transaction([], [Output("alice", 10)], 1)
+            utxos.apply_block(Block(1, "0", [coinbase], int(time.time()), 0, 1), "block1")
+            outpoint = (coinbase.compute_txid(), 0)
+
+            # double spend inside one block is rejected and nothing is written
+            view = CoinsView(utxos)
+            self.assertEqual(view.spend(outpoint).amount, 10)
+            self.assertIsNone(view.spend(outpoint))
+            view.discard()
+            self.assertIn(outpoint, utxos)
+
+            # an output created and spent in the same view never reaches the store
+            payment = Transaction([Input(outpoint[0], 0)], [Output("bob", 10)])
+            view.spend(outpoint)
+            view.add_outputs(payment)
+            view.spend((payment.compute_txid(), 0))
+            view.flush("block2")
+            self.assertEqual(utxos.unspent(), [])
+            self.assertEqual(list(utxos.get_undo("block2")), [outpoint])
+            self.assertGreater(utxos.cache.hits, 0)
+            utxos.close()
+
+    def test_memory_store(self):
+        self.check_store(MemoryUTXOStore())
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            utxos = SQLiteUTXOStore(os.path.join(directory, "utxos.sqlite3"))
+            try:
+                self.check_store(utxos)
+            finally:
+                utxos.close()
+
+
+class TestMempool(unittest.TestCase):
+
+    def test_double_spend_and_block_removal(self):
+        mempool = Mempool()
+        payment = Transaction([Input("coin", 0)], [Output("bob", 1)])
+        double_spend = Transaction([Input("coin", 0)], [Output("carol", 1)])
+        other = Transaction([Input("coin", 1)], [Output("dave", 1)])
+
+        self.assertTrue(mempool.add(payment))
+        self.assertFalse(mempool.add(payment))
+        self.assertFalse(mempool.add(double_spend))
+        self.assertTrue(mempool.add(other))
+
+        # a block confirming the conflicting transaction evicts ours
+        mempool.remove_block([double_spend])
+        self.assertEqual(list(mempool), [other])
+        self.assertFalse(mempool.is_spent(("coin", 0)))
+        self.assertEqual(mempool.size, transaction_size(other))
+
+        # confirming a parent keeps its child, a conflict removes both
+        parent = Transaction([Input("coin", 2)], [Output("bob", 1)])
+        child = Transaction([Input(parent.compute_txid(), 0)], [Output("carol", 1)])
+        mempool.add(parent)
+        mempool.add(child)
+        mempool.remove_block([parent])
+        self.assertEqual(list(mempool), [other, child])
+        mempool.add(parent)
+        mempool.remove_block([Transaction([Input("coin", 2)], [Output("eve", 1)])])
+        self.assertEqual(list(mempool), [other])
+
+    def test_eviction_and_expiry(self):
+        transactions = [Transaction([Input("coin", i)], [Output("bob", 1)]) for i in range(3)]
+        mempool = Mempool(max_bytes=2 * transaction_size(transactions[0]))
+        for tx in transactions:
+            self.assertTrue(mempool.add(tx))
+        self.assertEqual(list(mempool), transactions[1:]) # oldest evicted
+
+        mempool.expire(now=time.time() + mempool.expiry + 1)
+        self.assertEqual(len(mempool), 0)
+
+    def test_block_template_selection(self):
+        mempool = Mempool()
+        parent = Transaction([Input("coin", 0)], [Output("bob_long_address", 1)])
+        child = Transaction([Input(parent.compute_txid(), 0)], [Output("carol", 1)])
+        other = Transaction([Input("coin", 1)], [Output("dave", 1)])
+        for tx in (parent, child, other):
+            mempool.add(tx)
+
+        self.assertEqual(mempool.select(), [parent, child, other])
+        self.assertEqual(mempool.select(max_count=1), [parent])
+        # no room for the parent -> its child is left out as well
+        self.assertEqual(mempool.select(max_bytes=transaction_size(other)), [other])
+
+
+class TestBlockDocuments(unittest.TestCase):
+
+    def test_document_round_trip(self):
+        private_key, address = generate_address()
+        payment = Transaction([Input("ab" * 32, 0)], [Output(address, 1.5)], 2)
+        payment.sign(private_key)
+        block = Block(3, "cd" * 32, [Transaction([], [Output(address, 1)], 3), payment], int(time.time()), 77, 2)
+
+        document = block_to_document(block)
+        self.assertEqual((document["_id"], document["orphaned"]), (block.compute_hash(), False))
+        restored = document_to_block(document)
+        self.assertEqual(restored.compute_hash(), block.compute_hash())
+        self.assertTrue(restored.transactions[1].verify())
+
+
+class TestFlatFileBlockStore(unittest.TestCase):
+
+    def test_append_reopen_and_reorg(self):
+        with tempfile.TemporaryDirectory() as directory:
+            chain = make_chain(5)
+            store = FlatFileBlockStore(directory)
+            store.blocks_connected(chain)
+            store.blocks_disconnected(chain[3:])
+            fork = Block(3, chain[2].compute_hash(), [], 100, 0, 0)
+            store.blocks_connected([fork])
+            store.close_connection()
+
+            store = FlatFileBlockStore(directory) # index only is read on open
+            self.assertEqual(len(store), 4)
+            self.assertEqual(store.read_block_data(3), encode_block(fork))
+            self.assertIsNone(store.read_block_data(4))
+            self.assertIsNone(store.get_block(chain[4].compute_hash()))
+            self.assertEqual(store.get_block(chain[1].compute_hash()).compute_hash(), chain[1].compute_hash())
+            self.assertEqual([b.compute_hash() for b in store.load_blockchain_data()],
+                             [b.compute_hash() for b in chain[:3] + [fork]])
+            with self.assertRaises(ValueError):
+                store.blocks_connected([chain[0], make_chain(7)[6]]) # gap
+            # a new genesis block does not replace the stored chain
+            with self.assertRaises(ValueError):
+                store.blocks_connected([Block(0, "0" * 64, [], 2, 0, 0)])
+            self.assertEqual(len(store), 4)
+            store.close_connection()
+
+    def test_blockchain_with_block_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            node = Node(HOST, 2232)
+            node.log = False
+            blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=FlatFileBlockStore(directory))
+            peer = RecordingPeer((HOST, 1))
+            node.peer_sockets = {peer.address: peer}
+            try:
+                blockchain.difficulty = 2
+                blockchain.create_genesis_block(difficulty=2)
+                _, miner = generate_address()
+                blockchain.mine(miner)
+                node.handle_message(peer, Message('GET_BLOCK', 1))
+                self.assertEqual(peer.sent(node)[-1].data, encode_block(blockchain.chain[1]))
+            finally:
+                blockchain.miner.close()
+                node.close()
+                blockchain.storage_manager.close_connection()
+
+            reopened = FlatFileBlockStore(directory)
+            self.assertEqual(reopened.load_blockchain_data()[-1].compute_hash(), blockchain.latest_block().compute_hash())
+            reopened.close_connection()
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_frames_across_reads(self):
+        left, right = socket.socketpair()
+        big = Message('BLOCK', 'x' * 600000) # larger than one receive buffer
+        data = Message('GET_PEERS', None).to_frame() + big.to_frame() + Message('PORT', 6000).to_frame()
+        def send():
+            left.sendall(data)
+            left.close()
+        sender = threading.Thread(target=send)
+        sender.start()
+
+        reader = FrameReader(right)
+        received = []
+        while (frame := reader.read_frame()) is not None:
+            received.append(bytes_to_Message(frame))
+        sender.join()
+        right.close()
+
+        self.assertEqual([m.m_type for m in received], ['GET_PEERS', 'BLOCK', 'PORT'])
+        self.assertEqual(received[1].data, big.data)
+        self.assertEqual(received[2].data, 6000)
+
+    def test_oversized_frame_rejected(self):
+        left, right = socket.socketpair()
+        left.sendall(Message('BLOCK', 'x' * 100).to_frame())
+        with self.assertRaises(ValueError):
+            FrameReader(right, max_size=50).read_frame()
+        left.close()
+        right.close()
+
+
+class TestCodec(unittest.TestCase):
+
+    def signed_transaction(self):
+        private_key, address = generate_address()
+        transaction = Transaction([Input("ab" * 32, 1)], [Output(address, 2.5), Output("change", 0.125)], 3)
+        transaction.sign(private_key)
+        return transaction
+
+    def test_transaction_round_trip(self):
+        transaction = self.signed_transaction()
+        decoded = decode_transaction(encode_transaction(transaction))
+        self.assertEqual(decoded.compute_txid(), transaction.compute_txid())
+        self.assertEqual(decoded.inputs[0].signature, transaction.inputs[0].signature)
+        self.assertEqual(decoded.inputs[0].public_key, transaction.inputs[0].public_key)
+        self.assertTrue(decoded.verify())
+
+    def test_block_round_trip(self):
+        coinbase = Transaction([], [Output("miner", 6.25)])
+        block = Block(7, "0" * 64, [coinbase, self.signed_transaction()], int(time.time()), 12345, 4)
+        data = encode_block(block)
+        decoded = decode_block(data)
+        self.assertEqual(decoded.compute_hash(), block.compute_hash())
+        self.assertEqual(decoded.nonce, block.nonce)
+        self.assertEqual(encode_block(decoded), data)
+        self.assertLess(len(data), len(jsonpickle.encode(block)))
+
+        # blocks past the size limit are left out, the first one always goes in
+        self.assertEqual(len(decode_blocks(encode_blocks([block] * 3, 2 * len(data)))), 1)
+        self.assertEqual(len(decode_blocks(encode_blocks([block] * 3, 2 * len(data) + 16))), 2)
+        self.assertEqual(len(decode_blocks(encode_blocks([block] * 3, 1))), 1)
+
+    def test_malformed_data_rejected(self):
+        data = encode_block(Block(1, "0" * 64, [self.signed_transaction()], int(time.time()), 0, 4))
+        with self.assertRaises(ValueError):
+            decode_block(b'\x09' + data[1:]) # unknown version
+        with self.assertRaises(ValueError):
+            decode_block(data[:-3])
+        with self.assertRaises(ValueError):
+            decode_block(data + b'\x00')
+
+    def test_message_envelope(self):
+        data = encode_transaction(self.signed_transaction())
+        message = bytes_to_Message(Message('NEW_TRANSACTION', data, True).to_bytes())
+        self.assertEqual((message.m_type, message.data, message.broadcast), ('NEW_TRANSACTION', data, True))
+        message = bytes_to_Message(Message('PEERS_LIST', [[HOST, 2222]]).to_bytes())
+        self.assertEqual((message.data, message.broadcast), ([[HOST, 2222]], False))
+
+
+# Collects the messages a node sends to it
+class RecordingPeer:
+    def __init__(self, address):
+        self.address = address
+        self.received = []
+
+    def getpeername(self):
+        return self.address
+
+    def sendall(self, frame):
+        self.received.append(bytes_to_Message(frame[4:]))
+
+    # messages written so far, once the node's writer emptied the queue
+    def sent(self, node):
+        node.send_queue(self).join(timeout=5)
+        return self.received
+
+    def close(self):
+        pass
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+
+class TestInventoryRelay(unittest.TestCase):
+
+    def test_announce_and_fetch(self):
+        node = Node(HOST, 2250)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        first, second = RecordingPeer((HOST, 1)), RecordingPeer((HOST, 2))
+        node.peer_sockets = {first.address: first, second.address: second}
+        try:
+            tx = Transaction([Input("coin", 0)], [Output("bob", 1)])
+            txid = tx.compute_txid()
+            blockchain.unconfirmed_transactions.add(tx)
+
+            # an item the first peer announced is not announced back to it
+            node.handle_message(first, Message('INV', [['tx', txid]]))
+            self.assertEqual(first.sent(node), [])
+            node.new_transaction(tx)
+            self.assertEqual(first.sent(node), [])
+            self.assertEqual([(m.m_type, m.data) for m in second.sent(node)], [('INV', [['tx', txid]])])
+
+            node.handle_message(second, Message('GETDATA', [['tx', txid]]))
+            self.assertEqual(second.sent(node)[-1].m_type, 'NEW_TRANSACTION')
+            self.assertEqual(decode_transaction(second.sent(node)[-1].data).compute_txid(), txid)
+
+            # unknown items are requested from one peer only
+            unknown = [['block', 'ff' * 32]]
+            node.handle_message(first, Message('INV', unknown))
+            node.handle_message(second, Message('INV', unknown))
+            self.assertEqual((first.sent(node)[-1].m_type, first.sent(node)[-1].data), ('GETDATA', unknown))
+            self.assertEqual(second.sent(node)[-1].m_type, 'NEW_TRANSACTION')
+
+            # handled items are not requested or processed again, even once they left the pool
+            blockchain.unconfirmed_transactions.remove(txid)
+            node.handle_message(second, Message('INV', [['tx', txid]]))
+            self.assertEqual(second.sent(node)[-1].m_type, 'NEW_TRANSACTION')
+            node.handle_message(first, Message('NEW_TRANSACTION', encode_transaction(tx)))
+            self.assertNotIn(txid, blockchain.unconfirmed_transactions)
+            self.assertEqual(node.processed_items.hits, 2)
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_rejected_items_are_retried(self):
+        node = Node(HOST, 2253)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        peer = RecordingPeer((HOST, 1))
+        node.peer_sockets = {peer.address: peer}
+        try:
+            private_key, address = generate_address()
+            coinbase = Transaction([], [Output(address, 10)], 1)
+            blockchain.utxos.apply_block(Block(1, "0" * 64, [coinbase], 1, 0, 0), "block1")
+            parent = Transaction([Input(coinbase.compute_txid(), 0)], [Output(address, 10)])
+            parent.sign(private_key)
+            child = Transaction([Input(parent.compute_txid(), 0)], [Output("bob", 10)])
+            child.sign(private_key)
+
+            # the child is rejected while its parent is missing, it is accepted once the parent arrives
+            node.handle_message(peer, Message('NEW_TRANSACTION', encode_transaction(child)))
+            self.assertNotIn(child.compute_txid(), blockchain.unconfirmed_transactions)
+            node.handle_message(peer, Message('NEW_TRANSACTION', encode_transaction(parent)))
+            node.handle_message(peer, Message('NEW_TRANSACTION', encode_transaction(child)))
+            self.assertIn(child.compute_txid(), blockchain.unconfirmed_transactions)
+            node.handle_message(peer, Message('NEW_TRANSACTION', encode_transaction(child)))
+            self.assertEqual(node.processed_items.hits, 1)
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+
+class TestCompactBlocks(unittest.TestCase):
+
+    def make_block(self):
+        coinbase = Transaction([], [Output("miner", 1)], 1)
+        transactions = [Transaction([Input("coin", i)], [Output("bob", i + 1)]) for i in range(3)]
+        return Block(1, "0" * 64, [coinbase] + transactions, int(time.time()), 42, 2), transactions
+
+    def test_rebuild_from_mempool(self):
+        block, transactions = self.make_block()
+        data = CompactBlock.from_block(block).encode()
+        self.assertLess(len(data), len(encode_block(block)))
+
+        compact = CompactBlock.decode(data)
+        self.assertEqual(compact.block_hash, block.compute_hash())
+        self.assertEqual(compact.fill_from(transactions[:2]), [3]) # coinbase is sent in full
+        compact.fill_missing([3], transactions[2:])
+        self.assertEqual(compact.to_block().compute_hash(), block.compute_hash())
+
+        wrong = CompactBlock.decode(data)
+        wrong.fill_missing([1, 2, 3], [transactions[1], transactions[0], transactions[2]])
+        self.assertIsNone(wrong.to_block())
+
+    def test_missing_transactions_requested(self):
+        node = Node(HOST, 2251)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        peer = RecordingPeer((HOST, 1))
+        node.peer_sockets = {peer.address: peer}
+        try:
+            block, transactions = self.make_block()
+            for tx in transactions[:2]:
+                blockchain.unconfirmed_transactions.add(tx)
+            node.handle_message(peer, Message('CMPCTBLOCK', CompactBlock.from_block(block).encode()))
+            request = peer.sent(node)[-1]
+            self.assertEqual((request.m_type, request.data), ('GETBLOCKTXN', {'hash': block.compute_hash(), 'positions': [3]}))
+            self.assertIn(block.compute_hash(), node.pending_blocks)
+
+            node.handle_message(peer, Message('BLOCKTXN', encode_block_transactions(block.compute_hash(), transactions[2:])))
+            self.assertNotIn(block.compute_hash(), node.pending_blocks)
+
+            # a reply missing transactions falls back to the full block
+            other = Block(1, "0" * 64, block.transactions, block.timestamp, 43, 2)
+            node.handle_message(peer, Message('CMPCTBLOCK', CompactBlock.from_block(other).encode()))
+            node.handle_message(peer, Message('BLOCKTXN', encode_block_transactions(other.compute_hash(), [])))
+            request = peer.sent(node)[-1]
+            self.assertEqual((request.m_type, request.data), ('GETDATA', [['block', other.compute_hash()]]))
+
+            # requests for positions outside the block are not answered
+            sent = len(peer.sent(node))
+            node.handle_message(peer, Message('GETBLOCKTXN', {'hash': block.compute_hash(), 'positions': [3, 4]}))
+            self.assertEqual(len(peer.sent(node)), sent)
+            node.handle_message(peer, Message('GETBLOCKTXN', {'hash': block.compute_hash(), 'positions': [3]}))
+            self.assertEqual(peer.sent(node)[-1].m_type, 'BLOCKTXN')
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+
+class TestMessageFilter(unittest.TestCase):
+
+    def test_ids_expire_after_two_generations(self):
+        seen = MessageFilter(bits=1 << 12, capacity=100, generation_time=60)
+        ids = [hashlib.sha256(bytes([i])).digest() for i in range(3)]
+        seen.add(ids[0])
+        self.assertIn(ids[0], seen)
+        self.assertNotIn(ids[1], seen)
+        self.assertEqual((seen.hits, seen.misses), (1, 1))
+
+        seen.rotate(now=seen.started + 60)
+        self.assertIn(ids[0], seen) # still in the previous filter
+        seen.rotate(now=seen.started + 60)
+        self.assertNotIn(ids[0], seen)
+
+        for i in range(100): # a full generation rotates early
+            seen.add(hashlib.sha256(i.to_bytes(4, 'big')).digest())
+        seen.add(ids[2])
+        self.assertEqual(seen.rotations, 3)
+        self.assertLess(seen.false_positive_rate(), 0.01)
+
+
+class TestBlockDownloader(unittest.TestCase):
+
+    def test_ranges_from_several_peers(self):
+        chain = make_chain(41)
+        first, second = object(), object()
+        downloader = BlockDownloader(range_size=8, requests_per_peer=2, stall_timeout=10)
+        downloader.request_headers(first)
+        headers = [BlockHeader.from_block(block) for block in chain[1:]]
+        self.assertTrue(downloader.add_headers(first, headers, BlockHeader.from_block(chain[0])))
+
+        requests = downloader.assign([first, second])
+        self.assertEqual(requests, [(first, 1, 8), (second, 9, 8), (first, 17, 8), (second, 25, 8)])
+        self.assertEqual(downloader.receive(second, chain[9:17]), []) # waits for blocks 1-8
+        self.assertEqual(downloader.receive(second, chain[25:33]), [])
+
+        # the first peer stalls, its ranges go to the second one
+        downloader.reassign_stalled(now=time.time() + 11)
+        self.assertEqual(downloader.assign([first, second]), [(second, 1, 8), (second, 17, 8)])
+        self.assertEqual(downloader.receive(second, chain[1:9]), chain[1:17])
+
+        # blocks that don't match the headers are requested again
+        self.assertEqual(downloader.receive(second, [chain[17]] + chain[19:26]), [chain[17]])
+        self.assertIn(second, downloader.excluded)
+        self.assertEqual(downloader.assign([first, second])[0], (first, 18, 7))
+
+    def test_short_reply_and_late_headers(self):
+        chain = make_chain(21)
+        peer = object()
+        downloader = BlockDownloader(range_size=8, requests_per_peer=1)
+        downloader.request_headers(peer)
+        headers = [BlockHeader.from_block(block) for block in chain[1:11]]
+        self.assertTrue(downloader.add_headers(peer, headers, BlockHeader.from_block(chain[0])))
+        downloader.request_headers(peer) # the first batch was full, more headers are asked for
+
+        # a reply cut short by the size limit is continued without excluding the peer
+        self.assertEqual(downloader.assign([peer]), [(peer, 1, 8)])
+        self.assertEqual(downloader.receive(peer, chain[1:4]), chain[1:4])
+        self.assertNotIn(peer, downloader.excluded)
+        self.assertEqual(downloader.assign([peer]), [(peer, 4, 5)])
+        downloader.receive(peer, chain[4:9])
+        self.assertEqual(downloader.assign([peer]), [(peer, 9, 2)])
+        self.assertEqual(downloader.receive(peer, chain[9:11]), chain[9:11])
+
+        # all blocks are in, the late headers reply is still accepted
+        self.assertTrue(downloader.syncing())
+        headers = [BlockHeader.from_block(block) for block in chain[11:]]
+        self.assertTrue(downloader.add_headers(peer, headers, BlockHeader.from_block(chain[10])))
+        self.assertEqual(downloader.assign([peer]), [(peer, 11, 8)])
+
+    def test_known_blocks_keep_the_sync(self):
+        node = Node(HOST, 2254)
+        node.log = False
+        blockchain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        try:
+            chain = make_chain(4)
+            peer = object()
+            node.downloader.request_headers(peer)
+            headers = [BlockHeader.from_block(block) for block in chain[1:]]
+            self.assertTrue(node.downloader.add_headers(peer, headers, BlockHeader.from_block(chain[0])))
+            for block in chain[:2]: # block 1 was relayed while downloading
+                blockchain.receive_block(block)
+
+            node.connect_downloaded(chain[1:3])
+            self.assertEqual(list(blockchain.chain), chain[:3])
+            self.assertTrue(node.downloader.syncing())
+        finally:
+            blockchain.miner.close()
+            node.close()
+
+    def test_headers_must_continue_the_chain(self):
+        chain = make_chain(5)
+        peer = object()
+        downloader = BlockDownloader()
+        downloader.request_headers(peer)
+        headers = [BlockHeader.from_block(block) for block in chain[2:]]
+        self.assertFalse(downloader.add_headers(peer, headers, BlockHeader.from_block(chain[0])))
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def test_priorities_and_limit(self):
+        queue = SendQueue(max_bytes=10)
+        self.assertTrue(queue.put(b'tx', PRIORITY_TX))
+        self.assertTrue(queue.put(b'ping'))
+        self.assertTrue(queue.put(b'blk', PRIORITY_BLOCK))
+        self.assertFalse(queue.put(b'tx2', PRIORITY_TX)) # 12 bytes would not fit
+        self.assertEqual(queue.depth(), {'frames': 3, 'bytes': 9, 'dropped': 1})
+        self.assertEqual([queue.pop() for _ in range(4)], [b'blk', b'ping', b'tx', None])
+
+        self.assertTrue(queue.put(b'x' * 20, PRIORITY_BLOCK)) # larger than the limit, but the queue is empty
+        self.assertFalse(queue.put(b'tx', PRIORITY_TX))
+        self.assertEqual(queue.pop(), b'x' * 20)
+
+        queue.close()
+        self.assertIsNone(queue.get())
+        self.assertFalse(queue.put(b'late'))
+        self.assertEqual(queue.depth()['dropped'], 2) # closed is not an overflow
+
+    def test_overflow_of_stalled_peer(self):
+        node = Node(HOST, 2252)
+        node.log = False
+        peer = RecordingPeer((HOST, 1))
+        peer.shut_down = False
+        node.peer_sockets = {peer.address: peer}
+        node.send_queues[peer] = SendQueue(max_bytes=200) # no writer, the peer never reads
+        try:
+            transaction = Message('NEW_TRANSACTION', b'x' * 80)
+            node.send_to_peer(peer, transaction)
+            node.send_to_peer(peer, transaction) # dropped
+            self.assertFalse(peer.shut_down)
+            self.assertEqual(node.queue_depths()[peer.address]['dropped'], 1)
+
+            node.send_to_peer(peer, Message('NEW_BLOCK', b'x' * 150))
+            self.assertTrue(peer.shut_down)
+            self.assertTrue(node.send_queues[peer].closed)
+        finally:
+            node.close()
+
+
+class TestAsyncNode(unittest.TestCase):
+
+    def test_sync_genesis_between_nodes(self):
+        seed = AsyncNode(HOST, 2240)
+        seed.log = False
+        seed_chain = Blockchain(seed, utxos=MemoryUTXOStore(), storage=NullStorage())
+        seed_chain.create_genesis_block(difficulty=2)
+
+        node = AsyncNode(HOST, 2241)
+        node.log = False
+        chain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        try:
+            node.connect_to_peer(HOST, 2240)
+            deadline = time.time() + 10
+            while len(chain.chain) == 0 and time.time() < deadline:
+                time.sleep(0.05)
+
+            self.assertEqual(chain.latest_block().compute_hash(), seed_chain.latest_block().compute_hash())
+            self.assertIn((HOST, 2241), seed.listen_ports.values()) # PORT handled on the seed's loop
+        finally:
+            for blockchain in (seed_chain, chain):
+                blockchain.miner.close()
+                blockchain.node.close()
+
+    def test_headers_first_sync(self):
+        seed = AsyncNode(HOST, 2242)
+        seed.log = False
+        seed_chain = Blockchain(seed, utxos=MemoryUTXOStore(), storage=NullStorage())
+        seed_chain.difficulty = 2
+        seed_chain.create_genesis_block(difficulty=2)
+        _, miner = generate_address()
+        for _ in range(4):
+            seed_chain.mine(miner)
+        time.sleep(1.1) # blocks from the current second are rejected
+
+        node = AsyncNode(HOST, 2243)
+        node.log = False
+        chain = Blockchain(node, utxos=MemoryUTXOStore(), storage=NullStorage())
+        try:
+            node.connect_to_peer(HOST, 2242)
+            deadline = time.time() + 10
+            while len(chain.chain) < 5 and time.time() < deadline:
+                time.sleep(0.05)
+
+            self.assertEqual(chain.latest_block().compute_hash(), seed_chain.latest_block().compute_hash())
+            self.assertEqual(chain.get_balance(miner), 4)
+            self.assertFalse(node.downloader.syncing())
+        finally:
+            for blockchain in (seed_chain, chain):
+                blockchain.miner.close()
+                blockchain.node.close()
@@ -1,5 +1,7 @@
 import ecdsa
 import json
+import struct
+from functools import lru_cache
 from typing import List
 from functions import *
 
@@ -7,6 +9,34 @@ from functions import *
     Transaction and UTXO scheme implementing P2PKH
 """
 
+# Canonical encoding used for txids: big-endian integers, length-prefixed UTF-8 strings
+def pack_str(value) -> bytes:
+    data = str(value).encode()
+    return struct.pack('>H', len(data)) + data
+
+KEY_CACHE_SIZE = 4096 # parsed public keys, the same addresses sign over and over
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def verifying_key(public_key):
+    return ecdsa.VerifyingKey.from_string(bytes.fromhex(public_key), curve=ecdsa.SECP256k1)
+
+def verify_signature(public_key, signature, tx_id) -> bool:
+    try:
+        return verifying_key(public_key).verify(bytes.fromhex(signature), tx_id.encode())
+    except (ecdsa.BadSignatureError, ecdsa.MalformedPointError, ValueError):
+        return False
+
+# check = (txid, input index, signature, public_key)
+def verify_check(check) -> bool:
+    tx_id, _, signature, public_key = check
+    return verify_signature(public_key, signature, tx_id)
+
+# returns (string, offset after it)
+def unpack_str(data, offset=0):
+    (length,) = struct.unpack_from('>H', data, offset)
+    start = offset + 2
+    return bytes(data[start:start + length]).decode(), start + length
+
 class Input:
     
     # In real BTC - use ScriptPubKey instead of storing public key
@@ -16,6 +46,10 @@ class Input:
         self.signature = None
         self.public_key = None
 
+    # signature and public key are not part of the txid
+    def serialize(self) -> bytes:
+        return pack_str(self.prev_txid) + struct.pack('>I', self.vout)
+
     def sign(self, tx_id, private_key_bytes, public_key) -> None:
         sk = ecdsa.SigningKey.from_string(private_key_bytes, curve=ecdsa.SECP256k1) # derive ECDSA private key
         self.signature = sk.sign(tx_id.encode()).hex() # sign the hash of inputs/outputs
@@ -26,22 +60,54 @@ class Output:
         self.address = address # receiver address 
         self.amount = amount
 
+    def serialize(self) -> bytes:
+        return pack_str(self.address) + struct.pack('>d', self.amount)
+
+    @staticmethod
+    def deserialize(data, offset=0) -> 'Output':
+        address, offset = unpack_str(data, offset)
+        (amount,) = struct.unpack_from('>d', data, offset)
+        return Output(address, amount)
+
 class Transaction:
     def __init__(self, inputs: List[Input], outputs: List[Output], index=0):
         self.inputs = inputs
         self.outputs = outputs
         self.signature = None
         self.index = index # for distinguishing of coinbase txs
+        self._txid = None
+
+    # the cached txid is never serialized, it is recomputed on demand
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_txid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._txid = None
+
+    # Mutations of inputs/outputs must go through these to keep the txid cache valid
+    def add_input(self, input: Input):
+        self.inputs.append(input)
+        self._txid = None
+
+    def add_output(self, output: Output):
+        self.outputs.append(output)
+        self._txid = None
+
+    # without signatures
+    def serialize(self) -> bytes:
+        parts = [struct.pack('>IH', self.index, len(self.inputs))]
+        parts.extend(inp.serialize() for inp in self.inputs)
+        parts.append(struct.pack('>H', len(self.outputs)))
+        parts.extend(out.serialize() for out in self.outputs)
+        return b''.join(parts)
 
     def compute_txid(self) -> str:
-        # without signatures
-        tx_data = {
-            'inputs': [{'prev_txid': inp.prev_txid, 'vout': inp.vout} for inp in self.inputs],
-            'outputs': [{'address': out.address, 'amount': out.amount} for out in self.outputs],
-            'index': self.index
-        }
-        tx_string = json.dumps(tx_data, sort_keys=True)
-        return hashlib.sha256(tx_string.encode()).hexdigest()
+        if self._txid is None:
+            self._txid = hashlib.sha256(self.serialize()).hexdigest()
+        return self._txid
 
     def sign(self, private_key):
         private_key_bytes = bytes.fromhex(private_key)
@@ -52,13 +118,19 @@ class Transaction:
             input.sign(tx_id, private_key_bytes, public_key)
 
 
-    def verify(self) -> bool:
+    # (txid, input index, signature, public_key) to check for every input, None if an input is unsigned
+    def signature_checks(self):
         tx_id = self.compute_txid()
-        # Verify each input
-        for input in self.inputs:
+        checks = []
+        for index, input in enumerate(self.inputs):
             if not input.public_key or not input.signature:
-                return False
-            vk = ecdsa.VerifyingKey.from_string(bytes.fromhex(input.public_key), curve=ecdsa.SECP256k1)
-            if not vk.verify(bytes.fromhex(input.signature), tx_id.encode()):
-                return False  
-        return True
+                return None
+            checks.append((tx_id, index, input.signature, input.public_key))
+        return checks
+
+    def verify(self) -> bool:
+        checks = self.signature_checks()
+        if checks is None:
+            return False
+        # Verify each input
+        return all(verify_check(check) for check in checks)
@@ -0,0 +1,484 @@
+import redis
+import sqlite3
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from transaction import Input, Output, unpack_str
+
+"""
+    UTXO set storage with interchangeable backends.
+    Every backend keeps the outputs by outpoint (txid, vout), a secondary
+    index and running balance per address, the hash of the last applied
+    block and per-block undo data (outputs spent by the block) for reorgs.
+    A block is applied or undone as one atomic write.
+    Blocks are validated against a CoinsView, an in-memory overlay that
+    fetches all referenced outputs up front and writes only the net delta.
+"""
+
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+SQLITE_PATH = 'utxos.sqlite3'
+BEST_BLOCK_KEY = 'best_block'
+OUTPUT_CACHE_SIZE = 100000 # recently created outputs kept in memory
+MAX_UNDO_DEPTH = 100 # blocks below the tip keeping undo data, deeper reorgs rebuild the set
+
+def utxo_key(txid, vout):
+    return f"utxo:{txid}:{vout}"
+
+def undo_key(block_hash):
+    return f"undo:{block_hash}"
+
+# count, then (txid, vout, output) of every spent output
+def encode_undo(spent_outputs):
+    parts = [struct.pack('>I', len(spent_outputs))]
+    for (txid, vout), output in spent_outputs.items():
+        parts.append(Input(txid, vout).serialize())
+        parts.append(output.serialize())
+    return b''.join(parts)
+
+def decode_undo(data):
+    spent_outputs = {}
+    (count,) = struct.unpack_from('>I', data)
+    offset = 4
+    for _ in range(count):
+        txid, offset = unpack_str(data, offset)
+        (vout,) = struct.unpack_from('>I', data, offset)
+        address, offset = unpack_str(data, offset + 4)
+        (amount,) = struct.unpack_from('>d', data, offset)
+        spent_outputs[(txid, vout)] = Output(address, amount)
+        offset += 8
+    return spent_outputs
+
+# Net effect of a block: outpoints it spends from the set, outputs it adds.
+# Outputs created and spent inside the same block never reach the store.
+def block_delta(block):
+    spent = []
+    created = {}
+    for tx in block.transactions:
+        for input in tx.inputs:
+            outpoint = (input.prev_txid, input.vout)
+            if outpoint in created:
+                del created[outpoint]
+            else:
+                spent.append(outpoint)
+
+        tx_id = tx.compute_txid()
+        for vout, output in enumerate(tx.outputs):
+            created[(tx_id, vout)] = output
+    return spent, created
+
+def balance_deltas(removed, added):
+    balances = defaultdict(float)
+    for output in removed.values():
+        balances[output.address] -= output.amount
+    for output in added.values():
+        balances[output.address] += output.amount
+    return {address: delta for address, delta in balances.items() if delta}
+
+
+# LRU of recently created outputs, most spends are of recent outputs
+class OutputCache:
+    def __init__(self, max_size=OUTPUT_CACHE_SIZE):
+        self.max_size = max_size
+        self.outputs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, outpoint):
+        output = self.outputs.get(outpoint)
+        if output is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.outputs.move_to_end(outpoint)
+        return output
+
+    def put(self, outpoint, output):
+        if self.max_size <= 0:
+            return
+        self.outputs[outpoint] = output
+        self.outputs.move_to_end(outpoint)
+        while len(self.outputs) > self.max_size:
+            self.outputs.popitem(last=False)
+
+    def discard(self, outpoint):
+        self.outputs.pop(outpoint, None)
+
+    def clear(self):
+        self.outputs.clear()
+
+
+class UTXOStore(ABC):
+    """
+        Block-level logic shared by all backends. A backend implements
+        get_many, outpoints, all_outpoints, balance, best_block, get_undo,
+        write and clear.
+    """
+
+    def __init__(self, cache_size=OUTPUT_CACHE_SIZE):
+        self.cache = OutputCache(cache_size)
+
+    # {outpoint: output} for the outpoints that exist
+    @abstractmethod
+    def get_many(self, outpoints):
+        pass
+
+    @abstractmethod
+    def outpoints(self, address):
+        pass
+
+    @abstractmethod
+    def all_outpoints(self):
+        pass
+
+    @abstractmethod
+    def balance(self, address):
+        pass
+
+    @abstractmethod
+    def best_block(self):
+        pass
+
+    @abstractmethod
+    def get_undo(self, block_hash):
+        pass
+
+    # Atomically remove and add outputs, store undo=(block_hash, spent outputs)
+    # or drop the undo record of drop_undo, and move the best block marker
+    @abstractmethod
+    def write(self, removed, added, best_block, undo=None, drop_undo=None):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def reset(self):
+        self.clear()
+        self.cache.clear()
+
+    def close(self):
+        pass
+
+    # get_many behind the output cache
+    def fetch(self, outpoints):
+        found = {}
+        missing = []
+        for outpoint in outpoints:
+            output = self.cache.get(outpoint)
+            if output is not None:
+                found[outpoint] = output
+            else:
+                missing.append(outpoint)
+        if missing:
+            found.update(self.get_many(missing))
+        return found
+
+    # write and keep the output cache consistent
+    def commit(self, removed, added, best_block, undo=None, drop_undo=None):
+        self.write(removed, added, best_block, undo, drop_undo)
+        for outpoint in removed:
+            self.cache.discard(outpoint)
+        for outpoint, output in added.items():
+            self.cache.put(outpoint, output)
+
+    def get(self, txid, vout):
+        return self.fetch([(txid, vout)]).get((txid, vout))
+
+    def __contains__(self, outpoint):
+        return self.get(*outpoint) is not None
+
+    def __getitem__(self, outpoint):
+        output = self.get(*outpoint)
+        if output is None:
+            raise KeyError(outpoint)
+        return output
+
+    def apply_block(self, block, block_hash, drop_undo=None):
+        view = CoinsView(self)
+        view.apply_block(block)
+        view.flush(block_hash, drop_undo)
+
+    # Reverse apply_block using its undo data, False if there is none
+    def disconnect_block(self, block, block_hash):
+        restored = self.get_undo(block_hash)
+        if restored is None:
+            return False
+        _, created = block_delta(block)
+        self.commit(created, restored, block.previous_hash, drop_undo=block_hash)
+        return True
+
+    # [((txid, vout), output)] of one address, or of the whole set
+    def unspent(self, address=None):
+        outpoints = self.outpoints(address) if address is not None else self.all_outpoints()
+        return list(self.get_many(outpoints).items())
+
+
+# In-process dicts, nothing survives a restart
+class MemoryUTXOStore(UTXOStore):
+    def __init__(self):
+        super().__init__(cache_size=0) # already in memory
+        self.lock = threading.Lock()
+        self.clear()
+
+    def get_many(self, outpoints):
+        return {outpoint: self.utxos[outpoint] for outpoint in outpoints if outpoint in self.utxos}
+
+    def outpoints(self, address):
+        return list(self.by_address.get(address, ()))
+
+    def all_outpoints(self):
+        return list(self.utxos)
+
+    def balance(self, address):
+        return self.balances.get(address, 0)
+
+    def best_block(self):
+        return self.best
+
+    def get_undo(self, block_hash):
+        return self.undo.get(block_hash)
+
+    def write(self, removed, added, best_block, undo=None, drop_undo=None):
+        with self.lock:
+            for outpoint, output in removed.items():
+                self.utxos.pop(outpoint, None)
+                self.by_address[output.address].discard(outpoint)
+            for outpoint, output in added.items():
+                self.utxos[outpoint] = output
+                self.by_address[output.address].add(outpoint)
+            for address, delta in balance_deltas(removed, added).items():
+                self.balances[address] = self.balances.get(address, 0) + delta
+            if undo is not None:
+                self.undo[undo[0]] = dict(undo[1])
+            if drop_undo is not None:
+                self.undo.pop(drop_undo, None)
+            self.best = best_block
+
+    def clear(self):
+        self.utxos = {}
+        self.by_address = defaultdict(set)
+        self.balances = {}
+        self.undo = {}
+        self.best = None
+
+
+# Embedded on-disk store, one SQLite transaction per block
+class SQLiteUTXOStore(UTXOStore):
+    def __init__(self, path=SQLITE_PATH, cache_size=OUTPUT_CACHE_SIZE):
+        super().__init__(cache_size)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS utxos (txid TEXT, vout INTEGER, address TEXT, amount REAL,
+                                                  PRIMARY KEY (txid, vout));
+                CREATE INDEX IF NOT EXISTS utxos_address ON utxos (address);
+                CREATE TABLE IF NOT EXISTS balances (address TEXT PRIMARY KEY, amount REAL);
+                CREATE TABLE IF NOT EXISTS undo (block_hash TEXT PRIMARY KEY, data BLOB);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+
+    def get_many(self, outpoints):
+        found = {}
+        with self.lock:
+            for outpoint in outpoints:
+                row = self.db.execute("SELECT address, amount FROM utxos WHERE txid = ? AND vout = ?",
+                                      outpoint).fetchone()
+                if row is not None:
+                    found[outpoint] = Output(*row)
+        return found
+
+    def outpoints(self, address):
+        with self.lock:
+            rows = self.db.execute("SELECT txid, vout FROM utxos WHERE address = ?", (address,)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def all_outpoints(self):
+        with self.lock:
+            rows = self.db.execute("SELECT txid, vout FROM utxos").fetchall()
+        return [tuple(row) for row in rows]
+
+    def balance(self, address):
+        with self.lock:
+            row = self.db.execute("SELECT amount FROM balances WHERE address = ?", (address,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def best_block(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (BEST_BLOCK_KEY,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_undo(self, block_hash):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM undo WHERE block_hash = ?", (block_hash,)).fetchone()
+        return decode_undo(row[0]) if row is not None else None
+
+    def write(self, removed, added, best_block, undo=None, drop_undo=None):
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM utxos WHERE txid = ? AND vout = ?", removed.keys())
+            self.db.executemany("INSERT OR REPLACE INTO utxos VALUES (?, ?, ?, ?)",
+                                [(txid, vout, output.address, output.amount)
+                                 for (txid, vout), output in added.items()])
+            self.db.executemany("""INSERT INTO balances VALUES (?, ?)
+                                   ON CONFLICT (address) DO UPDATE SET amount = amount + excluded.amount""",
+                                balance_deltas(removed, added).items())
+            if undo is not None:
+                self.db.execute("INSERT OR REPLACE INTO undo VALUES (?, ?)", (undo[0], encode_undo(undo[1])))
+            if drop_undo is not None:
+                self.db.execute("DELETE FROM undo WHERE block_hash = ?", (drop_undo,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (BEST_BLOCK_KEY, best_block))
+
+    def clear(self):
+        with self.lock, self.db:
+            for table in ('utxos', 'balances', 'undo', 'meta'):
+                self.db.execute(f"DELETE FROM {table}")
+
+    def close(self):
+        self.db.close()
+
+
+# Redis keys: utxo:<txid>:<vout> -> output, addr:<address> -> set of outpoints,
+# balance:<address> -> running balance, undo:<block hash>, best_block
+# Each write is one pipelined MULTI/EXEC transaction
+class RedisUTXOStore(UTXOStore):
+    def __init__(self, host=REDIS_HOST, port=REDIS_PORT, db=0, cache_size=OUTPUT_CACHE_SIZE):
+        super().__init__(cache_size)
+        self.redis = redis.Redis(host=host, port=port, db=db)
+
+    # one MGET for many outpoints
+    def get_many(self, outpoints):
+        outpoints = list(outpoints)
+        if not outpoints:
+            return {}
+        values = self.redis.mget([utxo_key(txid, vout) for txid, vout in outpoints])
+        return {outpoint: Output.deserialize(data)
+                for outpoint, data in zip(outpoints, values) if data is not None}
+
+    def outpoints(self, address):
+        outpoints = []
+        for member in self.redis.smembers(f"addr:{address}"):
+            txid, vout = member.decode().split(':')
+            outpoints.append((txid, int(vout)))
+        return outpoints
+
+    def all_outpoints(self):
+        outpoints = []
+        for key in self.redis.scan_iter("utxo:*"):
+            _, txid, vout = key.decode().split(':')
+            outpoints.append((txid, int(vout)))
+        return outpoints
+
+    def balance(self, address):
+        balance = self.redis.get(f"balance:{address}")
+        return float(balance) if balance is not None else 0
+
+    def best_block(self):
+        best = self.redis.get(BEST_BLOCK_KEY)
+        return best.decode() if best is not None else None
+
+    def get_undo(self, block_hash):
+        data = self.redis.get(undo_key(block_hash))
+        return decode_undo(data) if data is not None else None
+
+    def write(self, removed, added, best_block, undo=None, drop_undo=None):
+        pipe = self.redis.pipeline(transaction=True)
+        for (txid, vout), output in removed.items():
+            pipe.delete(utxo_key(txid, vout))
+            pipe.srem(f"addr:{output.address}", f"{txid}:{vout}")
+        for (txid, vout), output in added.items():
+            pipe.set(utxo_key(txid, vout), output.serialize())
+            pipe.sadd(f"addr:{output.address}", f"{txid}:{vout}")
+        for address, delta in balance_deltas(removed, added).items():
+            pipe.incrbyfloat(f"balance:{address}", delta)
+        if undo is not None:
+            pipe.set(undo_key(undo[0]), encode_undo(undo[1]))
+        if drop_undo is not None:
+            pipe.delete(undo_key(drop_undo))
+        pipe.set(BEST_BLOCK_KEY, best_block)
+        pipe.execute()
+
+    def clear(self):
+        self.redis.flushdb()
+
+    def close(self):
+        self.redis.close()
+
+
+# Overlay of a store for one block: outputs are fetched up front, spends and
+# creates happen in memory, flush writes the net delta, discard drops it
+class CoinsView:
+    def __init__(self, store: UTXOStore):
+        self.store = store
+        self.fetched = {} # outputs read from the store
+        self.spent = {} # outputs of the store spent in this view
+        self.created = {} # outputs added in this view, not in the store
+
+    # one batched read for every input of the block
+    def prefetch(self, block):
+        outpoints = [(input.prev_txid, input.vout) for tx in block.transactions for input in tx.inputs]
+        missing = [outpoint for outpoint in outpoints
+                   if outpoint not in self.fetched and outpoint not in self.created]
+        self.fetched.update(self.store.fetch(missing))
+
+    def get(self, outpoint):
+        if outpoint in self.created:
+            return self.created[outpoint]
+        if outpoint in self.spent:
+            return None
+        if outpoint not in self.fetched:
+            self.fetched.update(self.store.fetch([outpoint]))
+        return self.fetched.get(outpoint)
+
+    def __contains__(self, outpoint):
+        return self.get(outpoint) is not None
+
+    def __getitem__(self, outpoint):
+        output = self.get(outpoint)
+        if output is None:
+            raise KeyError(outpoint)
+        return output
+
+    # returns the spent output, None if it is missing or already spent
+    def spend(self, outpoint):
+        if outpoint in self.created:
+            return self.created.pop(outpoint)
+        output = self.get(outpoint)
+        if output is not None:
+            self.spent[outpoint] = output
+        return output
+
+    def add_outputs(self, tx):
+        tx_id = tx.compute_txid()
+        for vout, output in enumerate(tx.outputs):
+            self.created[(tx_id, vout)] = output
+
+    # apply without validation, missing inputs are ignored
+    def apply_block(self, block):
+        self.prefetch(block)
+        for tx in block.transactions:
+            for input in tx.inputs:
+                self.spend((input.prev_txid, input.vout))
+            self.add_outputs(tx)
+
+    # drop_undo: undo record of a block now too deep to be disconnected
+    def flush(self, block_hash, drop_undo=None):
+        self.store.commit(self.spent, self.created, block_hash, undo=(block_hash, self.spent), drop_undo=drop_undo)
+        self.discard()
+
+    def discard(self):
+        self.fetched = {}
+        self.spent = {}
+        self.created = {}
+
+
+UTXO_BACKENDS = {
+    'memory': MemoryUTXOStore,
+    'sqlite': SQLiteUTXOStore,
+    'redis': RedisUTXOStore,
+}
+
+# backend by name, e.g. 'sqlite' or 'memory' on a single machine to skip the Redis round trips
+def open_utxo_store(backend='redis', **kwargs) -> UTXOStore:
+    return UTXO_BACKENDS[backend](**kwargs)
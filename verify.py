@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from transaction import verify_check
+
+"""
+    Batch ECDSA verification: the (txid, input index, signature, public_key) checks of a
+    whole block are split into chunks and verified on a process pool,
+    the first failing chunk cancels the rest.
+    Checks that already succeeded (e.g. when the transaction entered the
+    mempool) are skipped through a bounded SignatureCache.
+"""
+
+VERIFY_CHUNK = 64 # signatures per task
+MIN_PARALLEL = 128 # smaller batches are verified inline, IPC would cost more
+SIGNATURE_CACHE_SIZE = 50000
+
+# Runs inside a worker process, each worker has its own verifying key cache
+def _verify_chunk(checks):
+    for check in checks:
+        if not verify_check(check):
+            return False
+    return True
+
+
+# LRU of successful (txid, input index, signature, public_key) checks
+class SignatureCache:
+    def __init__(self, max_size=SIGNATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, check):
+        with self.lock:
+            if check in self.entries:
+                self.entries.move_to_end(check)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_all(self, checks):
+        with self.lock:
+            for check in checks:
+                self.entries[check] = None
+                self.entries.move_to_end(check)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class BatchVerifier:
+    def __init__(self, workers=None, chunk_size=VERIFY_CHUNK, min_parallel=MIN_PARALLEL, cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.min_parallel = min_parallel
+        self.pool = None
+
+    def start(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def verify(self, checks) -> bool:
+        if self.cache is not None:
+            checks = [check for check in checks if check not in self.cache]
+        if not self.verify_uncached(checks):
+            return False
+        if self.cache is not None:
+            self.cache.add_all(checks)
+        return True
+
+    def verify_uncached(self, checks) -> bool:
+        if len(checks) < self.min_parallel or self.workers == 1:
+            return _verify_chunk(checks)
+
+        self.start()
+        pending = {self.pool.submit(_verify_chunk, checks[i:i + self.chunk_size])
+                   for i in range(0, len(checks), self.chunk_size)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if not all(future.result() for future in done):
+                for future in pending:
+                    future.cancel()
+                return False
+        return True
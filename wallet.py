@@ -16,7 +16,7 @@ class Wallet:
         return self.blockchain.get_balance(address)
 
     def get_utxos(self, address):
-        return [u for u in self.blockchain.utxos.values() if u.address == address]
+        return self.blockchain.utxos.unspent(address)
 
     def transfer(self, sender_address, recipient_address, amount):
         # Find the private key for the sender address